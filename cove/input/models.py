@@ -32,6 +32,8 @@ class SuppliedData(models.Model):
     schema_version = models.CharField(max_length=10, default='')
     # Schema version in uploaded/linked file
     data_schema_version = models.CharField(max_length=10, default='')
+    # sha256 of original_file, set the first time the data is explored
+    file_digest = models.CharField(max_length=64, default='')
 
     form_name = models.CharField(
         max_length=20,
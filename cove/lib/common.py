@@ -3,10 +3,13 @@ import csv
 import datetime
 import functools
 import fcntl
+import io
 import json
 import os
 import re
+import threading
 from collections import OrderedDict
+from decimal import Decimal
 from urllib.parse import urlparse, urljoin
 
 import jsonref
@@ -20,11 +23,19 @@ from jsonschema.validators import Draft4Validator as validator
 from django.utils.html import escape, conditional_escape, format_html
 
 from cove.lib.exceptions import cove_spreadsheet_conversion_error
-from cove.lib.tools import cached_get_request, decimal_default
+from cove.lib.tools import cached_get_request, decimal_default, disk_cached_get_text, http_session, json_loads
+
+try:
+    import fastjsonschema
+    from fastjsonschema.draft04 import CodeGeneratorDraft04
+except ImportError:
+    fastjsonschema = None
 
 
 uniqueItemsValidator = validator.VALIDATORS.pop("uniqueItems")
-LANGUAGE_RE = re.compile("^(.*_(((([A-Za-z]{2,3}(-([A-Za-z]{3}(-[A-Za-z]{3}){0,2}))?)|[A-Za-z]{4}|[A-Za-z]{5,8})(-([A-Za-z]{4}))?(-([A-Za-z]{2}|[0-9]{3}))?(-([A-Za-z0-9]{5,8}|[0-9][A-Za-z0-9]{3}))*(-([0-9A-WY-Za-wy-z](-[A-Za-z0-9]{2,8})+))*(-(x(-[A-Za-z0-9]{1,8})+))?)|(x(-[A-Za-z0-9]{1,8})+)))$")
+LANGUAGE_TAG_PATTERN = "((([A-Za-z]{2,3}(-([A-Za-z]{3}(-[A-Za-z]{3}){0,2}))?)|[A-Za-z]{4}|[A-Za-z]{5,8})(-([A-Za-z]{4}))?(-([A-Za-z]{2}|[0-9]{3}))?(-([A-Za-z0-9]{5,8}|[0-9][A-Za-z0-9]{3}))*(-([0-9A-WY-Za-wy-z](-[A-Za-z0-9]{2,8})+))*(-(x(-[A-Za-z0-9]{1,8})+))?)|(x(-[A-Za-z0-9]{1,8})+)"
+LANGUAGE_RE = re.compile("^(.*_(" + LANGUAGE_TAG_PATTERN + "))$")
+LANGUAGE_TAG_RE = re.compile(LANGUAGE_TAG_PATTERN)
 validation_error_template_lookup = {'date-time': 'Date is not in the correct format',
                            'uri': 'Invalid \'uri\' found',
                            'string': '\'{}\' is not a string. Check that the value {} has quotes at the start and end. Escape any quotes in the value with \'\\\'',
@@ -96,23 +107,48 @@ class CustomRefResolver(RefResolver):
         return result
 
 
+def _deref_schema_obj(schema_obj, schema_host):
+    loader = CustomJsonrefLoader(schema_url=schema_host)
+    deref_obj = jsonref.JsonRef.replace_refs(schema_obj, loader=loader)
+    # Force evaluation of the references here
+    repr(deref_obj)
+    return deref_obj
+
+
+@functools.lru_cache(maxsize=32)
+def _deref_schema(schema_str, schema_host):
+    return _deref_schema_obj(json.loads(schema_str, object_pairs_hook=OrderedDict), schema_host)
+
+
+@functools.lru_cache(maxsize=32)
+def _schema_fields(schema_str, schema_host):
+    return frozenset(schema_dict_fields_generator(_deref_schema(schema_str, schema_host)))
+
+
 class SchemaJsonMixin():
     @cached_property
     def release_schema_str(self):
+        if getattr(self, 'schema_cache_dir', None):
+            return disk_cached_get_text(self.release_schema_url, self.schema_cache_dir)
         if getattr(self, 'cache_schema', False):
             response = cached_get_request(self.release_schema_url)
         else:
             response = requests.get(self.release_schema_url)
+        # Raise rather than keep an error page as the schema
+        response.raise_for_status()
         return response.text
 
     @cached_property
     def release_pkg_schema_str(self):
         uri_scheme = urlparse(self.release_pkg_schema_url).scheme
         if uri_scheme == 'http' or uri_scheme == 'https':
+            if getattr(self, 'schema_cache_dir', None):
+                return disk_cached_get_text(self.release_pkg_schema_url, self.schema_cache_dir)
             if getattr(self, 'cache_schema', False):
                 response = cached_get_request(self.release_pkg_schema_url)
             else:
                 response = requests.get(self.release_pkg_schema_url)
+            response.raise_for_status()
             return response.text
         else:
             with open(self.release_pkg_schema_url) as fp:
@@ -124,19 +160,40 @@ class SchemaJsonMixin():
 
     @property
     def _release_pkg_schema_obj(self):
-        return json.loads(self.release_pkg_schema_str)
+        return json_loads(self.release_pkg_schema_str)
 
-    def deref_schema(self, schema_str):
-        loader = CustomJsonrefLoader(schema_url=self.schema_host)
+    def deref_schema(self, schema_str, cache=True):
+        '''Return schema_str parsed with its $refs resolved.
+
+        The result is shared with every other caller asking for the same
+        schema_str and schema_host, so it must not be changed. Pass
+        cache=False to get a new object that can be.'''
         try:
-            deref_obj = jsonref.loads(schema_str, loader=loader, object_pairs_hook=OrderedDict)
-            # Force evaluation of jsonref.loads here
-            repr(deref_obj)
-            return deref_obj
+            if cache:
+                return _deref_schema(schema_str, self.schema_host)
+            return _deref_schema.__wrapped__(schema_str, self.schema_host)
         except jsonref.JsonRefError as e:
             self.json_deref_error = e.message
             return {}
 
+    def deref_schema_obj(self, schema_obj):
+        '''Return a copy of the already parsed schema_obj with its $refs resolved.'''
+        try:
+            return _deref_schema_obj(schema_obj, self.schema_host)
+        except jsonref.JsonRefError as e:
+            self.json_deref_error = e.message
+            return {}
+
+    def deref_schema_fields(self, schema_str):
+        '''Return the set of field paths in schema_str once dereferenced.
+
+        Shared in the same way as deref_schema's result.'''
+        try:
+            return _schema_fields(schema_str, self.schema_host)
+        except jsonref.JsonRefError as e:
+            self.json_deref_error = e.message
+            return frozenset()
+
     def get_release_schema_obj(self, deref=False):
         if deref:
             return self.deref_schema(self.release_schema_str)
@@ -148,11 +205,13 @@ class SchemaJsonMixin():
         return self._release_pkg_schema_obj
 
     def get_release_pkg_schema_fields(self):
-        return set(schema_dict_fields_generator(self.get_release_pkg_schema_obj(deref=True)))
+        if getattr(self, 'extended', False):
+            return set(schema_dict_fields_generator(self.get_release_pkg_schema_obj(deref=True)))
+        return self.deref_schema_fields(self.release_pkg_schema_str)
 
 
 def common_checks_context(upload_dir, json_data, schema_obj, schema_name, context, extra_checkers=None,
-                          fields_regex=False, api=False, cache=True):
+                          fields_regex=False, api=False, cache=True, schema_validator=None):
     schema_version = getattr(schema_obj, 'version', None)
     schema_version_choices = getattr(schema_obj, 'version_choices', None)
 
@@ -192,7 +251,8 @@ def common_checks_context(upload_dir, json_data, schema_obj, schema_name, contex
     else:
         validation_errors = get_schema_validation_errors(json_data, schema_obj, schema_name,
                                                          cell_source_map, heading_source_map,
-                                                         extra_checkers=extra_checkers)
+                                                         extra_checkers=extra_checkers,
+                                                         schema_validator=schema_validator)
         if cache:
             with open(validation_errors_path, 'w+') as validation_error_fp:
                 json.dump(validation_errors, validation_error_fp, sort_keys=True, indent=2, default=decimal_default)
@@ -232,8 +292,9 @@ def common_checks_context(upload_dir, json_data, schema_obj, schema_name, contex
 
 def unique_ids(validator, ui, instance, schema):
     if ui and validator.is_type(instance, "array"):
-        non_unique_ids = set()
-        all_ids = set()
+        # ids seen so far, mapped to whether they have been seen more than once
+        seen_ids = {}
+        non_unique_ids = []
         for item in instance:
             try:
                 item_id = item.get('id')
@@ -241,9 +302,12 @@ def unique_ids(validator, ui, instance, schema):
                 # if item is not a dict
                 item_id = None
             if item_id and not isinstance(item_id, list) and not isinstance(item_id, dict):
-                if item_id in all_ids:
-                    non_unique_ids.add(item_id)
-                all_ids.add(item_id)
+                if item_id in seen_ids:
+                    if not seen_ids[item_id]:
+                        seen_ids[item_id] = True
+                        non_unique_ids.append(item_id)
+                else:
+                    seen_ids[item_id] = False
             else:
                 # if there is any item without an id key, or the item is not a dict
                 # revert to original validator
@@ -253,7 +317,7 @@ def unique_ids(validator, ui, instance, schema):
 
         if non_unique_ids:
             msg = "Non-unique ID Values (first 3 shown):  {}"
-            yield ValidationError(msg.format(", ".join(str(x) for x in list(non_unique_ids)[:3])))
+            yield ValidationError(msg.format(", ".join(str(x) for x in non_unique_ids[:3])))
 
 
 def required_draft4(validator, required, instance, schema):
@@ -298,48 +362,74 @@ validator.VALIDATORS["uniqueItems"] = unique_ids
 validator.VALIDATORS["required"] = required_draft4
 validator.VALIDATORS["oneOf"] = oneOf_draft4
 
+# Checking formats doesn't change the checker, so validators without extra
+# checkers can all share this one
+default_format_checker = FormatChecker()
 
-def fields_present_generator(json_data, prefix=''):
-    if not isinstance(json_data, dict):
-        return
-    for key, value in json_data.items():
-        if isinstance(value, list):
-            for item in value:
-                if isinstance(item, dict):
-                    yield from fields_present_generator(item, prefix + '/' + key)
-            yield prefix + '/' + key
-        elif isinstance(value, dict):
-            yield from fields_present_generator(value, prefix + '/' + key)
-            yield prefix + '/' + key
-        else:
-            yield prefix + '/' + key
 
-
-def get_fields_present(*args, **kwargs):
-    counter = collections.Counter()
-    counter.update(fields_present_generator(*args, **kwargs))
-    return dict(counter)
+def get_fields_present(json_data):
+    '''Count how many times each field path (e.g. /releases/tender/id) is used in json_data.'''
+    if not isinstance(json_data, dict):
+        return {}
+    paths = []
+    add_path = paths.append
+    stack = [(json_data, '')]
+    while stack:
+        obj, prefix = stack.pop()
+        for key, value in obj.items():
+            path = prefix + '/' + key
+            add_path(path)
+            if isinstance(value, list):
+                for item in value:
+                    if isinstance(item, dict):
+                        stack.append((item, path))
+            elif isinstance(value, dict):
+                stack.append((value, path))
+    return dict(collections.Counter(paths))
 
 
 def schema_dict_fields_generator(schema_dict):
-    if 'properties' in schema_dict and isinstance(schema_dict['properties'], dict):
+    # Each entry is either a schema to expand, with the path of the field it is
+    # for, or a path to yield. Fields are yielded after their children.
+    stack = [(schema_dict, '')]
+    while stack:
+        entry = stack.pop()
+        if isinstance(entry, str):
+            yield entry
+            continue
+
+        schema_dict, prefix = entry
+        if 'properties' not in schema_dict or not isinstance(schema_dict['properties'], dict):
+            continue
+        entries = []
         for property_name, value in schema_dict['properties'].items():
+            path = prefix + '/' + property_name
             if 'oneOf' in value:
                 property_schema_dicts = value['oneOf']
             else:
-                property_schema_dicts = [value]
+                property_schema_dicts = (value,)
             for property_schema_dict in property_schema_dicts:
                 if not isinstance(property_schema_dict, dict):
                     continue
                 property_type_set = get_property_type_set(property_schema_dict)
                 if 'object' in property_type_set:
-                    for field in schema_dict_fields_generator(property_schema_dict):
-                        yield '/' + property_name + field
+                    entries.append((property_schema_dict, path))
                 elif 'array' in property_type_set:
-                    fields = schema_dict_fields_generator(property_schema_dict.get('items', {}))
-                    for field in fields:
-                        yield '/' + property_name + field
-                yield '/' + property_name
+                    entries.append((property_schema_dict.get('items', {}), path))
+                entries.append(path)
+        stack.extend(reversed(entries))
+
+
+def is_language_field(name):
+    '''Return whether name ends in _ and a language tag, e.g. title_fr.
+
+    This gives the same result as LANGUAGE_RE.search(name). Language tags
+    can't contain _, so only the part after the last _ needs matching.'''
+    if '\n' in name:
+        # . and $ treat newlines specially, leave those to the full regex
+        return LANGUAGE_RE.search(name) is not None
+    index = name.rfind('_')
+    return index != -1 and LANGUAGE_TAG_RE.fullmatch(name, index + 1) is not None
 
 
 def get_counts_additional_fields(json_data, schema_obj, schema_name, context, fields_regex=False):
@@ -357,23 +447,32 @@ def get_counts_additional_fields(json_data, schema_obj, schema_name, context, fi
         # to make results less verbose
         if not parent_field or parent_field in schema_fields:
             if fields_regex:
-                if LANGUAGE_RE.search(field.split('/')[-1]):
+                if is_language_field(field.split('/')[-1]):
                     continue
             data_only.add(field)
 
     return [('/'.join(key.split('/')[:-1]), key.split('/')[-1], fields_present[key]) for key in data_only]
 
 
-def get_schema_validation_errors(json_data, schema_obj, schema_name, cell_src_map, heading_src_map, extra_checkers=None):
+def get_schema_validator(schema_obj, schema_name, extra_checkers=None):
+    '''Build the jsonschema validator used by get_schema_validation_errors.
+
+    The validator's resolver keeps any remote schemas it fetches, so reusing
+    a validator saves fetching them again. It also keeps a stack of scopes
+    while validating, so a validator must not be used by two threads at once.
+    '''
     if schema_name == 'record-package-schema.json':
         pkg_schema_obj = schema_obj.get_record_pkg_schema_obj()
     else:
         pkg_schema_obj = schema_obj.get_release_pkg_schema_obj()
 
-    validation_errors = collections.defaultdict(list)
-    format_checker = FormatChecker()
+    format_checker = default_format_checker
     if extra_checkers:
-        format_checker.checkers.update(extra_checkers)
+        # extra_checkers is in the form of FormatChecker.checkers:
+        # {format_name: (function, exceptions raised for invalid values)}
+        format_checker = FormatChecker()
+        for format_name, (func, raises) in extra_checkers.items():
+            format_checker.checks(format_name, raises)(func)
 
     if getattr(schema_obj, 'extended', None):
         resolver = CustomRefResolver('', pkg_schema_obj, schema_url=schema_obj.schema_host,
@@ -382,12 +481,150 @@ def get_schema_validation_errors(json_data, schema_obj, schema_name, cell_src_ma
     else:
         resolver = CustomRefResolver('', pkg_schema_obj, schema_url=schema_obj.schema_host)
 
-    our_validator = validator(pkg_schema_obj, format_checker=format_checker, resolver=resolver)
-    for e in our_validator.iter_errors(json_data):
+    return validator(pkg_schema_obj, format_checker=format_checker, resolver=resolver)
+
+
+# Validators are reused between requests, but each thread gets its own, see
+# get_schema_validator.
+_schema_validators = threading.local()
+
+
+def needs_jsonschema(json_data):
+    '''Return True if json_data has to be checked by jsonschema, i.e. if
+    fastjsonschema's result can't be relied on.
+
+    That is if it contains a Decimal, which fastjsonschema always rejects, or
+    if any list has two items with the same id, which is what cove's
+    uniqueItems validator (unique_ids) checks for on top of the standard
+    uniqueItems. It errs on the side of True, and stops at the first Decimal.'''
+    stack = [json_data]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            ids = set()
+            for item in value:
+                if isinstance(item, dict):
+                    item_id = item.get('id')
+                    if item_id and not isinstance(item_id, (list, dict)):
+                        if item_id in ids:
+                            return True
+                        ids.add(item_id)
+            stack.extend(value)
+        elif isinstance(value, Decimal):
+            return True
+    return False
+
+
+class FastValidator():
+    '''Check data with a compiled fastjsonschema function before jsonschema.
+
+    fastjsonschema stops at the first error, so it is only used to find data
+    that is valid. Anything it rejects is passed to the jsonschema validator,
+    which reports the full list of errors, so the results are the same either
+    way. Numbers parsed as Decimal are rejected by fastjsonschema, so data with
+    those (e.g. any 360Giving upload with a non-integer amount) goes straight
+    to jsonschema without trying fastjsonschema first.'''
+
+    def __init__(self, schema_obj, schema_name, schema_validator):
+        self.schema_host = schema_obj.schema_host
+        self.schema_cache_dir = getattr(schema_obj, 'schema_cache_dir', None)
+        self.cache_schema = getattr(schema_obj, 'cache_schema', False)
+        self.schema_validator = schema_validator
+        if schema_name == 'record-package-schema.json':
+            pkg_schema_obj = schema_obj.get_record_pkg_schema_obj()
+        else:
+            pkg_schema_obj = schema_obj.get_release_pkg_schema_obj()
+        # Use jsonschema's format checks, including any extra_checkers, so both
+        # agree on what is valid. Formats jsonschema has no check for pass.
+        format_checker = schema_validator.format_checker
+        formats = {name: functools.partial(format_checker.conforms, format=name)
+                   for name in set(CodeGeneratorDraft04.FORMAT_REGEXS) | set(format_checker.checkers)}
+        self.validate = fastjsonschema.compile(
+            pkg_schema_obj,
+            handlers={'http': self.fetch_schema, 'https': self.fetch_schema},
+            formats=formats,
+        )
+
+    def fetch_schema(self, uri):
+        # Resolve references the way CustomRefResolver does for jsonschema
+        uri = urljoin(self.schema_host, uri.split('/')[-1])
+        if uri.startswith('http'):
+            # Fetch it the way SchemaJsonMixin fetches schemas
+            if self.schema_cache_dir:
+                return json_loads(disk_cached_get_text(uri, self.schema_cache_dir))
+            if self.cache_schema:
+                response = cached_get_request(uri)
+            else:
+                response = http_session.get(uri)
+            response.raise_for_status()
+            return json_loads(response.text)
+        with open(uri) as schema_file:
+            return json.load(schema_file)
+
+    def iter_errors(self, instance):
+        if needs_jsonschema(instance):
+            return self.schema_validator.iter_errors(instance)
+        try:
+            self.validate(instance)
+        except fastjsonschema.JsonSchemaException:
+            return self.schema_validator.iter_errors(instance)
+        return iter(())
+
+
+def get_cached_schema_validator(schema_obj, schema_name, extra_checkers=None, fast=False):
+    '''Return a validator from get_schema_validator, reusing one built earlier
+    in this thread for the same schema.
+
+    If fast is True and fastjsonschema is installed, the validator is wrapped
+    in a FastValidator, unless fastjsonschema can't compile the schema (e.g.
+    it uses a format neither library knows). Validators for extended schemas
+    are built from a file in the upload's directory, so they are never reused
+    or wrapped.'''
+    if getattr(schema_obj, 'extended', None):
+        return get_schema_validator(schema_obj, schema_name, extra_checkers=extra_checkers)
+
+    fast = fast and fastjsonschema is not None
+    if schema_name == 'record-package-schema.json':
+        schema_url = schema_obj.record_pkg_schema_url
+    else:
+        schema_url = schema_obj.release_pkg_schema_url
+    key = (schema_url, schema_name, frozenset(extra_checkers.items()) if extra_checkers else None, fast)
+
+    validators = _schema_validators.__dict__.setdefault('validators', {})
+    if key not in validators:
+        schema_validator = get_schema_validator(schema_obj, schema_name, extra_checkers=extra_checkers)
+        if fast:
+            try:
+                schema_validator = FastValidator(schema_obj, schema_name, schema_validator)
+            except fastjsonschema.JsonSchemaDefinitionException:
+                # Use the jsonschema validator on its own
+                pass
+        validators[key] = schema_validator
+    return validators[key]
+
+
+def get_schema_validation_errors(json_data, schema_obj, schema_name, cell_src_map, heading_src_map, extra_checkers=None,
+                                 schema_validator=None):
+    if schema_validator is None:
+        schema_validator = get_schema_validator(schema_obj, schema_name, extra_checkers=extra_checkers)
+
+    validation_errors = collections.defaultdict(list)
+    for e in schema_validator.iter_errors(json_data):
         message_safe = None
         message = e.message
-        path = "/".join(str(item) for item in e.path)
-        path_no_number = "/".join(str(item) for item in e.path if not isinstance(item, int))
+        path_items = []
+        path_items_no_number = []
+        for item in e.path:
+            if isinstance(item, int):
+                path_items.append(str(item))
+            else:
+                item = str(item)
+                path_items.append(item)
+                path_items_no_number.append(item)
+        path = "/".join(path_items)
+        path_no_number = "/".join(path_items_no_number)
 
         value = {"path": path}
         cell_reference = cell_src_map.get(path)
@@ -515,29 +752,41 @@ def get_json_data_generic_paths(json_data, path=(), generic_paths=None):
     if generic_paths is None:
         generic_paths = {}
 
-    if isinstance(json_data, dict):
-        iterable = list(json_data.items())
-        if not iterable:
-            generic_paths[path] = {}
-    else:
-        iterable = list(enumerate(json_data))
-        if not iterable:
-            generic_paths[path] = []
-
-    for key, value in iterable:
-        generic_key = tuple(i for i in path + (key,) if type(i) != int)
+    # Walk the data depth first with a stack of iterators, rather than
+    # recursing, so that deeply nested data can't hit the recursion limit.
+    # Paths are visited in the same order as a recursive walk would.
+    generic_path = tuple(i for i in path if type(i) != int)
+    stack = [(path, generic_path, _generic_paths_items(json_data, path, generic_paths))]
+    while stack:
+        path, generic_path, items = stack[-1]
+        for key, value in items:
+            specific_key = path + (key,)
+            generic_key = generic_path if type(key) == int else generic_path + (key,)
+
+            if generic_paths.get(generic_key):
+                generic_paths[generic_key][specific_key] = value
+            else:
+                generic_paths[generic_key] = {specific_key: value}
 
-        if generic_paths.get(generic_key):
-            generic_paths[generic_key][path + (key,)] = value
+            if isinstance(value, (dict, list)):
+                stack.append((specific_key, generic_key, _generic_paths_items(value, specific_key, generic_paths)))
+                break
         else:
-            generic_paths[generic_key] = {path + (key,): value}
-
-        if isinstance(value, (dict, list)):
-            get_json_data_generic_paths(value, path + (key,), generic_paths)
+            stack.pop()
 
     return generic_paths
 
 
+def _generic_paths_items(json_data, path, generic_paths):
+    if isinstance(json_data, dict):
+        if not json_data:
+            generic_paths[path] = {}
+        return iter(list(json_data.items()))
+    if not json_data:
+        generic_paths[path] = []
+    return iter(list(enumerate(json_data)))
+
+
 def _get_schema_non_required_ids(schema_obj, obj=None, current_path=(), id_paths=None,
                                 array_parent=False, list_merge=False):
     '''Get a list of paths for schema non-required object['id'] in arrays of objects.
@@ -591,46 +840,78 @@ def get_json_data_missing_ids(json_data_paths, schema_obj):
     return sorted(missing_ids_paths)
 
 
-def _get_schema_deprecated_paths(schema_obj, obj=None, current_path=(), deprecated_paths=None):
-    '''Get a list of deprecated paths and explanations for deprecation in a schema.
+def _schema_properties(obj):
+    properties = obj.get('properties', {})
+    if not isinstance(properties, dict):
+        return iter(())
+    return iter(properties.items())
 
-    Deprecated paths are given as tuples of tuples:
-    ((path, to, field), (deprecation_version, description))
-    '''
-    if deprecated_paths is None:
-        deprecated_paths = []
 
-    if schema_obj:
-        obj = schema_obj.get_release_pkg_schema_obj(deref=True)
+def _walk_schema_paths(obj):
+    '''Get both the deprecated paths and the codelist paths in a dereferenced schema,
+    in one walk over it. See _get_schema_deprecated_paths and get_schema_codelist_paths.'''
+    deprecated_paths = []
+    codelist_paths = {}
 
-    properties = obj.get('properties', {})
-    if not isinstance(properties, dict):
-        return deprecated_paths
-    for prop, value in properties.items():
-        if current_path:
+    stack = [((), _schema_properties(obj))]
+    while stack:
+        current_path, properties = stack[-1]
+        for prop, value in properties:
             path = current_path + (prop,)
-        else:
-            path = (prop,)
 
-        if path not in deprecated_paths:
+            # Only a JsonRef has a __reference__, the {"$ref": ...} object it replaced,
+            # and checking the type is much cheaper than a failed getattr
             if "deprecated" in value:
-                deprecated_paths.append((
-                    path,
-                    (value['deprecated']['deprecatedVersion'], value['deprecated']['description'])
-                ))
-            elif getattr(value, '__reference__', None) and "deprecated" in value.__reference__:
-                deprecated_paths.append((
-                    path,
-                    (value.__reference__['deprecated']['deprecatedVersion'],
-                     value.__reference__['deprecated']['description'])
-                ))
+                deprecated = value['deprecated']
+            elif type(value) is jsonref.JsonRef and "deprecated" in value.__reference__:
+                deprecated = value.__reference__['deprecated']
+            else:
+                deprecated = None
+            if deprecated is not None:
+                deprecated_paths.append((path, (deprecated['deprecatedVersion'], deprecated['description'])))
+
+            if "codelist" in value:
+                codelist_paths[path] = (value['codelist'], value.get('openCodelist', False))
+
+            if value.get('type') == 'object':
+                stack.append((path, _schema_properties(value)))
+                break
+            elif value.get('type') == 'array' and value.get('items', {}).get('properties'):
+                stack.append((path, _schema_properties(value['items'])))
+                break
+        else:
+            stack.pop()
+
+    return deprecated_paths, codelist_paths
+
+
+@functools.lru_cache(maxsize=32)
+def _shared_schema_paths(schema_str, schema_host):
+    return _walk_schema_paths(_deref_schema(schema_str, schema_host))
 
-        if value.get('type') == 'object':
-            _get_schema_deprecated_paths(None, value, path, deprecated_paths)
-        elif value.get('type') == 'array' and value.get('items', {}).get('properties'):
-            _get_schema_deprecated_paths(None, value['items'], path, deprecated_paths)
 
-    return deprecated_paths
+def _get_release_pkg_schema_paths(schema_obj, use_extensions=True):
+    if getattr(schema_obj, 'extended', False) and use_extensions:
+        return _walk_schema_paths(schema_obj.get_release_pkg_schema_obj(deref=True))
+    # Otherwise the dereferenced schema is the shared one, so are its paths
+    try:
+        return _shared_schema_paths(schema_obj.release_pkg_schema_str, schema_obj.schema_host)
+    except jsonref.JsonRefError as e:
+        schema_obj.json_deref_error = e.message
+        return [], {}
+
+
+def _get_schema_deprecated_paths(schema_obj, obj=None):
+    '''Get a list of deprecated paths and explanations for deprecation in a schema.
+
+    Deprecated paths are given as tuples of tuples:
+    ((path, to, field), (deprecation_version, description))
+    '''
+    if schema_obj:
+        deprecated_paths, _ = _get_release_pkg_schema_paths(schema_obj)
+    else:
+        deprecated_paths, _ = _walk_schema_paths(obj)
+    return list(deprecated_paths)
 
 
 def get_json_data_deprecated_fields(json_data_paths, schema_obj):
@@ -690,54 +971,50 @@ def add_is_codelist(obj):
             add_is_codelist(value)
 
 
-def get_schema_codelist_paths(schema_obj, obj=None, current_path=(), codelist_paths=None, use_extensions=False):
+def get_schema_codelist_paths(schema_obj, obj=None, use_extensions=False):
     '''Get a dict of codelist paths including the filename and if they are open.
 
     codelist paths are given as tuples of tuples:
         {("path", "to", "codelist"): (filename, open?), ..}
     '''
-    if codelist_paths is None:
-        codelist_paths = {}
-
     if schema_obj:
-        obj = schema_obj.get_release_pkg_schema_obj(deref=True, use_extensions=use_extensions)
-
-    properties = obj.get('properties', {})
-    if not isinstance(properties, dict):
-        return codelist_paths
-    for prop, value in properties.items():
-        if current_path:
-            path = current_path + (prop,)
-        else:
-            path = (prop,)
-
-        if "codelist" in value and path not in codelist_paths:
-            codelist_paths[path] = (value['codelist'], value.get('openCodelist', False))
-
-        if value.get('type') == 'object':
-            get_schema_codelist_paths(None, value, path, codelist_paths)
-        elif value.get('type') == 'array' and value.get('items', {}).get('properties'):
-            get_schema_codelist_paths(None, value['items'], path, codelist_paths)
-
-    return codelist_paths
+        _, codelist_paths = _get_release_pkg_schema_paths(schema_obj, use_extensions=use_extensions)
+    else:
+        _, codelist_paths = _walk_schema_paths(obj)
+    return dict(codelist_paths)
 
 
 def load_codelist(url):
     codelist_map = {}
 
-    response = requests.get(url)
-    response.raise_for_status()
-    reader = csv.DictReader(line.decode("utf8") for line in response.iter_lines())
-    for record in reader:
-        code = record.get('Code') or record.get('code')
-        title = record.get('Title') or record.get('Title_en')
-        if not code:
-            return {}
-        codelist_map[code] = title
+    with http_session.get(url, stream=True) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        reader = csv.reader(io.TextIOWrapper(response.raw, encoding='utf-8', newline=''))
+        header = next(reader, [])
+        code_indexes = [header.index(name) if name in header else None for name in ('Code', 'code')]
+        title_indexes = [header.index(name) if name in header else None for name in ('Title', 'Title_en')]
+        for row in reader:
+            if not row:
+                continue
+            code = _first_value(row, code_indexes)
+            if not code:
+                return {}
+            codelist_map[code] = _first_value(row, title_indexes)
 
     return codelist_map
 
 
+def _first_value(row, indexes):
+    # Same as `row.get(first) or row.get(second)` on a csv.DictReader row
+    value = None
+    for index in indexes:
+        value = row[index] if index is not None and index < len(row) else None
+        if value:
+            break
+    return value
+
+
 @functools.lru_cache()
 def load_core_codelists(codelist_url, unique_files):
     codelists = {}
@@ -750,37 +1027,50 @@ def load_core_codelists(codelist_url, unique_files):
     return codelists
 
 
-def _generate_data_path(json_data, path=()):
+def _generate_codelist_data_values(json_data, codelist_paths):
+    """
+    Yield (path without array indexes, values) for every field in json_data at
+    one of codelist_paths, without descending into objects that can't lead to one.
+    """
     if not json_data or not isinstance(json_data, dict):
-        return path
-    for key, value in json_data.items():
-        if not value:
-            continue
-        if isinstance(value, list):
-            if isinstance(value[0], dict):
-                for num, item in enumerate(value):
-                    yield from _generate_data_path(item, path + (key, num))
-            else:
-                yield path + (key,), value
-        elif isinstance(value, dict):
-            yield from _generate_data_path(value, path + (key,))
+        return
+    prefixes = {path[:i] for path in codelist_paths for i in range(1, len(path))}
+
+    stack = [((), iter(json_data.items()))]
+    while stack:
+        path, items = stack[-1]
+        for key, value in items:
+            if not value:
+                continue
+            key_path = path + (key,)
+            if isinstance(value, dict):
+                if key_path in prefixes:
+                    stack.append((key_path, iter(value.items())))
+                    break
+            elif isinstance(value, list) and isinstance(value[0], dict):
+                if key_path in prefixes:
+                    stack.append((key_path, _dict_items_in_list(value)))
+                    break
+            elif key_path in codelist_paths:
+                yield key_path, value
         else:
-            yield path + (key,), value
+            stack.pop()
+
+
+def _dict_items_in_list(items):
+    for item in items:
+        if item and isinstance(item, dict):
+            yield from item.items()
 
 
 def get_additional_codelist_values(schema_obj, json_data):
     schema_obj.process_codelists()
 
     additional_codelist_values = {}
-    for path, values in _generate_data_path(json_data):
+    for path_no_num, values in _generate_codelist_data_values(json_data, schema_obj.extended_codelist_schema_paths):
         if not isinstance(values, list):
             values = [values]
 
-        path_no_num = tuple(key for key in path if isinstance(key, str))
-
-        if path_no_num not in schema_obj.extended_codelist_schema_paths:
-            continue
-
         codelist, isopen = schema_obj.extended_codelist_schema_paths[path_no_num]
 
         codelist_values = schema_obj.extended_codelists.get(codelist)
@@ -1,11 +1,15 @@
+import io
 import json
 import logging
 import os
 import shutil
 import warnings
+from collections import OrderedDict
 
 import flattentool
 import flattentool.exceptions
+import flattentool.input
+import openpyxl
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from flattentool.json_input import BadlyFormedJSONError
@@ -16,6 +20,50 @@ logger = logging.getLogger(__name__)
 config = settings.COVE_CONFIG
 
 
+class ReadOnlyXLSXInput(flattentool.input.XLSXInput):
+    '''flattentool's XLSXInput, but loading the workbook in read only mode.
+
+    Read only workbooks are parsed as they are iterated over rather than all
+    being held in memory, which uses far less memory for large spreadsheets.
+    They don't support reading by column, so vertically orientated sheets
+    (e.g. the metatab) are still loaded in full.
+    '''
+    def read_sheets(self):
+        if self.vertical_orientation:
+            return super().read_sheets()
+
+        # flattentool never closes the workbook, so don't leave it holding
+        # the file open.
+        with open(self.input_name, 'rb') as fp:
+            self.workbook = openpyxl.load_workbook(io.BytesIO(fp.read()), read_only=True, data_only=True)
+        # Read only worksheets take their size from the sheet's <dimension> tag,
+        # which some spreadsheet software writes wrongly (e.g. just "A1"), and
+        # would then silently drop the rows and columns outside it. Unset, the
+        # sheet is read to its end instead.
+        for worksheet in self.workbook.worksheets:
+            worksheet.max_row = worksheet.max_column = None
+
+        # The rest is XLSXInput.read_sheets, which can't be reused as it loads
+        # the workbook itself. test_read_only_xlsx_input_sheets checks they agree.
+        self.sheet_names_map = OrderedDict((sheet_name, sheet_name) for sheet_name in self.workbook.sheetnames)
+        if self.include_sheets:
+            for sheet in list(self.sheet_names_map):
+                if sheet not in self.include_sheets:
+                    self.sheet_names_map.pop(sheet)
+        for sheet in self.exclude_sheets or []:
+            self.sheet_names_map.pop(sheet, None)
+
+        self.sub_sheet_names = list(self.sheet_names_map.keys())
+        self.configure_sheets()
+
+
+# flattentool.unflatten looks up its input class by input_format, so make
+# ReadOnlyXLSXInput available under its own name rather than replacing the
+# 'xlsx' input for every other user of flattentool.
+READ_ONLY_XLSX_FORMAT = 'cove_read_only_xlsx'
+flattentool.input.FORMATS[READ_ONLY_XLSX_FORMAT] = ReadOnlyXLSXInput
+
+
 def filter_conversion_warnings(conversion_warnings):
     out = []
     for w in conversion_warnings:
@@ -64,7 +112,7 @@ def convert_spreadsheet(upload_dir, upload_url, file_name, file_type, schema_url
 
     flattentool_options = {
         'output_name': converted_path,
-        'input_format': file_type,
+        'input_format': READ_ONLY_XLSX_FORMAT if file_type == 'xlsx' else file_type,
         'root_list_path': config['root_list_path'],
         'encoding': encoding,
         'cell_source_map': cell_source_map_path,
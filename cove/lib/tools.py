@@ -1,10 +1,20 @@
+import hashlib
+import json
+import os
+import tempfile
 from functools import lru_cache, wraps  # use this to preserve function signatures and docstrings
 from decimal import Decimal
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from . exceptions import UnrecognisedFileType
 
+try:
+    import orjson
+except ImportError:  # orjson needs Python 3.6+
+    orjson = None
+
 
 def ignore_errors(f):
     @wraps(f)
@@ -86,6 +96,81 @@ def decimal_default(o):
     raise TypeError(repr(o) + " is not JSON serializable")
 
 
+# Shared between threads, for fetching schema files and codelists over a
+# pool of connections
+http_session = requests.Session()
+http_session.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=16))
+http_session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+
 @lru_cache(maxsize=64)
 def cached_get_request(url):
     return requests.get(url)
+
+
+@lru_cache(maxsize=64)
+def disk_cached_get_text(url, cache_dir):
+    '''Return the body of url, keeping a copy of it in cache_dir.
+
+    The copy is revalidated with its ETag or Last-Modified date the first time
+    a process asks for url, so a new worker doesn't download the body again
+    unless it changed.
+    If the request fails, or returns an error, the copy is used instead, or
+    if there is no copy the error is raised.'''
+    cache_file = os.path.join(cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+    cached = None
+    try:
+        with open(cache_file) as fp:
+            cached = json.load(fp)
+    except (OSError, ValueError):
+        pass
+
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+    try:
+        response = requests.get(url, headers=headers)
+    except requests.exceptions.RequestException:
+        if cached is None:
+            raise
+        return cached['text']
+
+    if response.status_code != 200:
+        # 304 Not Modified, or an error we don't want to replace the copy with
+        if cached is not None:
+            return cached['text']
+        # Raise rather than return the error page, which lru_cache would keep
+        response.raise_for_status()
+        raise requests.exceptions.HTTPError(
+            '{} response for url: {}'.format(response.status_code, url), response=response)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # A unique name, as other threads and processes may be writing the same file
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            json.dump({
+                'url': url,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'text': response.text,
+            }, fp)
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    return response.text
+
+
+def json_loads(text):
+    '''json.loads, using orjson when it is installed.
+
+    Anything orjson rejects is parsed with json instead.'''
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(text)
@@ -44,3 +44,15 @@ class CoveBaseCommand(BaseCommand):
             shutil.copy2(file, output_dir)
 
         self.output_dir = output_dir
+
+    def write_json(self, file_name, data, sort_keys=False):
+        '''Write data to file_name in the output directory, as JSON indented by 2.
+
+        The file is written under a temporary name and then moved into place, so
+        it is never left half written. The standard library encoder is kept, so
+        the output is byte for byte what it always was (e.g. \\u escapes).'''
+        path = os.path.join(self.output_dir, file_name)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            fp.write(json.dumps(data, indent=2, sort_keys=sort_keys, cls=SetEncoder))
+        os.replace(tmp_path, path)
@@ -1,3 +1,5 @@
+import json
+
 from django.core.management import call_command
 from cove.input.models import SuppliedData
 from django.core.files.base import ContentFile
@@ -5,6 +7,8 @@ import pytest
 import os
 from django.utils import timezone
 
+from cove.management.commands.base_command import CoveBaseCommand
+
 
 @pytest.mark.django_db
 def test_expire_files():
@@ -18,3 +22,16 @@ def test_expire_files():
     call_command('expire_files')
     assert os.path.exists(recent.upload_dir())
     assert not os.path.exists(old.upload_dir())
+
+
+def test_write_json(tmpdir):
+    command = CoveBaseCommand()
+    command.output_dir = str(tmpdir)
+    data = {'b': {'x', 'y'}, 'a': ['é', 1e16, 12345678901234567890123]}
+    command.write_json('results.json', data, sort_keys=True)
+    with open(str(tmpdir.join('results.json'))) as fp:
+        written = fp.read()
+    data['b'] = list(data['b'])
+    assert written == json.dumps(data, indent=2, sort_keys=True)
+    assert '\\u00e9' in written and '1e+16' in written
+    assert tmpdir.listdir() == [tmpdir.join('results.json')]
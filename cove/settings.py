@@ -43,6 +43,9 @@ env = environ.Env(  # set default values and casting
     SECRET_KEY=(str, secret_key),
     DB_NAME=(str, os.path.join(BASE_DIR, 'db.sqlite3')),
     DEBUG_TOOLBAR=(bool, False),
+    USE_FAST_VALIDATOR=(bool, False),
+    SCHEMA_CACHE_DIR=(str, ''),
+    CACHE_MAX_ENTRIES=(int, 50),
     # SCHEMA_URL_360=(str, 'https://raw.githubusercontent.com/ThreeSixtyGiving/standard/master/schema/'),
 )
 
@@ -71,6 +74,20 @@ DEBUG = env('DEBUG')
 
 ALLOWED_HOSTS = env('ALLOWED_HOSTS')
 
+# Check data with fastjsonschema before jsonschema, where supported
+USE_FAST_VALIDATOR = env('USE_FAST_VALIDATOR')
+
+# Keep copies of downloaded schemas here, revalidated with their ETag
+SCHEMA_CACHE_DIR = env('SCHEMA_CACHE_DIR')
+
+# Used to keep 360Giving check results between views of the same data. The
+# default is local to each process; set CACHE_URL (e.g. to
+# filecache:///var/tmp/cove or memcache://127.0.0.1:11211) to share it.
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+CACHES['default'].setdefault('OPTIONS', {}).setdefault('MAX_ENTRIES', env('CACHE_MAX_ENTRIES'))
+
 if env('SENTRY_DSN'):
     RAVEN_CONFIG = {
         'dsn': env('SENTRY_DSN'),
@@ -1,12 +1,21 @@
+import hashlib
 import json
 import os
+from decimal import Decimal
+from unittest.mock import Mock, patch
 
+import fastjsonschema
+import flattentool
+import flattentool.input
 import pytest
+import requests
 from django.core.files.uploadedfile import SimpleUploadedFile, UploadedFile
 
-from cove.lib.common import get_fields_present, get_json_data_generic_paths
+from cove.lib.common import (LANGUAGE_RE, FastValidator, get_cached_schema_validator, get_fields_present,
+                             get_json_data_generic_paths, get_schema_validator, is_language_field, validator)
+from cove.lib.converters import READ_ONLY_XLSX_FORMAT, ReadOnlyXLSXInput
 from cove.lib.exceptions import UnrecognisedFileType
-from cove.lib.tools import get_file_type
+from cove.lib.tools import disk_cached_get_text, get_file_type
 
 
 def test_fields_present():
@@ -22,6 +31,23 @@ def test_fields_present():
     assert get_fields_present({'a': {'c_1': [{'d': 1}, {'d': 1}]}, 'b_1': 2}) == {'/a': 1, '/a/c_1': 1, '/a/c_1/d': 2, '/b_1': 1}
 
 
+@pytest.mark.parametrize(('name', 'expected'), [
+    ('title_fr', True),
+    ('title_en-GB', True),
+    ('title_zh-Hant-TW', True),
+    ('title_x-private', True),
+    ('title', False),
+    ('title_', False),
+    ('title_es_', False),
+    ('title_toolonglanguage', False),
+    ('bad\nkey_fr', False),
+    ('key_fr\n', True),
+])
+def test_is_language_field(name, expected):
+    assert is_language_field(name) is expected
+    assert bool(LANGUAGE_RE.search(name)) is expected
+
+
 @pytest.mark.parametrize('file_name', ['basic.xlsx', 'basic.XLSX'])
 def test_get_file_type_xlsx(file_name):
     with open(os.path.join('cove', 'fixtures', 'basic.xlsx')) as fp:
@@ -56,3 +82,159 @@ def test_get_json_data_generic_paths():
         ('releases', 1, 'buyer', 'name'): 'Parks Canada',
         ('releases', 0, 'buyer', 'name'): 'Agriculture & Agrifood Canada'
     }
+
+
+@pytest.mark.parametrize('fixture', ['basic.xlsx', 'bad_dimension.xlsx'])
+def test_read_only_xlsx_input(tmpdir, fixture):
+    # bad_dimension.xlsx is basic.xlsx with each sheet's <dimension> tag set to "A1"
+    assert flattentool.input.FORMATS['xlsx'] is flattentool.input.XLSXInput
+    assert flattentool.input.FORMATS[READ_ONLY_XLSX_FORMAT] is ReadOnlyXLSXInput
+    outputs = []
+    for input_name, input_format in [('basic.xlsx', 'xlsx'), (fixture, READ_ONLY_XLSX_FORMAT)]:
+        output_dir = tmpdir.mkdir(input_format)
+        flattentool.unflatten(
+            os.path.join('cove', 'fixtures', input_name),
+            input_format=input_format,
+            output_name=str(output_dir.join('unflattened.json')),
+            cell_source_map=str(output_dir.join('cell_source_map.json')),
+            heading_source_map=str(output_dir.join('heading_source_map.json')),
+            root_list_path='main',
+        )
+        outputs.append([output_dir.join(name).read() for name in
+                        ['unflattened.json', 'cell_source_map.json', 'heading_source_map.json']])
+    assert outputs[0] == outputs[1]
+
+
+@pytest.mark.parametrize('sheets', [
+    {},
+    {'include_sheets': ['subsheet']},
+    {'exclude_sheets': ['subsheet']},
+    {'include_sheets': ['releases', 'subsheet'], 'exclude_sheets': ['releases']},
+])
+def test_read_only_xlsx_input_sheets(sheets):
+    # ReadOnlyXLSXInput.read_sheets repeats XLSXInput's sheet selection
+    inputs = []
+    for input_class in [flattentool.input.XLSXInput, ReadOnlyXLSXInput]:
+        spreadsheet_input = input_class(input_name=os.path.join('cove', 'fixtures', 'basic.xlsx'), **sheets)
+        spreadsheet_input.read_sheets()
+        inputs.append(spreadsheet_input)
+    assert inputs[0].sheet_names_map == inputs[1].sheet_names_map
+    assert inputs[0].sub_sheet_names == inputs[1].sub_sheet_names
+    assert inputs[0].sheet_configuration == inputs[1].sheet_configuration
+
+
+class FormatSchema():
+    schema_host = 'http://example.com/'
+
+    def __init__(self, format_name):
+        self.format_name = format_name
+        self.release_pkg_schema_url = 'http://example.com/{}.json'.format(format_name)
+
+    def get_release_pkg_schema_obj(self):
+        return {'properties': {'a': {'type': 'string', 'format': self.format_name}}}
+
+
+def test_fast_validator_extra_checkers():
+    extra_checkers = {'even-length': (lambda value: len(value) % 2 == 0, ValueError)}
+    schema_obj = FormatSchema('even-length')
+    schema_validator = get_schema_validator(schema_obj, 'release-package-schema.json', extra_checkers=extra_checkers)
+    fast_validator = FastValidator(schema_obj, 'release-package-schema.json', schema_validator)
+    fast_validator.validate({'a': 'ab'})
+    with pytest.raises(fastjsonschema.JsonSchemaException):
+        fast_validator.validate({'a': 'abc'})
+    assert [e.message for e in fast_validator.iter_errors({'a': 'abc'})] == ["'abc' is not a 'even-length'"]
+
+
+def test_fast_validator_skipped_for_decimals():
+    schema_obj = FormatSchema('email')
+    schema_validator = get_schema_validator(schema_obj, 'release-package-schema.json')
+    fast_validator = FastValidator(schema_obj, 'release-package-schema.json', schema_validator)
+    with patch.object(fast_validator, 'validate') as mock_validate:
+        assert list(fast_validator.iter_errors({'a': 'a@example.com', 'b': [{'c': Decimal('1.5')}]})) == []
+        assert not mock_validate.called
+        assert list(fast_validator.iter_errors({'a': 'a@example.com', 'b': [{'c': 1}]})) == []
+        assert mock_validate.called
+
+
+def test_get_cached_schema_validator_unknown_format():
+    schema_obj = FormatSchema('unknown-format')
+    schema_validator = get_cached_schema_validator(schema_obj, 'release-package-schema.json', fast=True)
+    assert not isinstance(schema_validator, FastValidator)
+    assert list(schema_validator.iter_errors({'a': 'anything'})) == []
+
+
+def test_fast_validator_fetch_schema(tmpdir):
+    schema_obj = FormatSchema('email')
+    schema_validator = get_schema_validator(schema_obj, 'release-package-schema.json')
+    fast_validator = FastValidator(schema_obj, 'release-package-schema.json', schema_validator)
+
+    with patch('cove.lib.common.http_session.get') as mock_get:
+        mock_get.return_value = Mock(text='{"type": "string"}')
+        assert fast_validator.fetch_schema('http://example.org/schemas/other.json') == {'type': 'string'}
+        mock_get.assert_called_once_with('http://example.com/other.json')
+        assert mock_get.return_value.raise_for_status.called
+
+    fast_validator.schema_cache_dir = str(tmpdir)
+    with patch('cove.lib.common.disk_cached_get_text', return_value='{"type": "object"}') as mock_get_text:
+        assert fast_validator.fetch_schema('http://example.org/schemas/other.json') == {'type': 'object'}
+        mock_get_text.assert_called_once_with('http://example.com/other.json', str(tmpdir))
+
+
+def test_disk_cached_get_text(tmpdir):
+    url = 'http://example.com/schema.json'
+    cache_dir = str(tmpdir)
+
+    with patch('cove.lib.tools.requests.get') as mock_get:
+        mock_get.return_value = Mock(status_code=200, text='{"a": 1}', headers={
+            'ETag': '"abc"', 'Last-Modified': 'Mon, 04 Jun 2018 10:00:00 GMT'})
+        disk_cached_get_text.cache_clear()
+        assert disk_cached_get_text(url, cache_dir) == '{"a": 1}'
+        mock_get.assert_called_once_with(url, headers={})
+
+        # Within a process the text is only fetched once
+        assert disk_cached_get_text(url, cache_dir) == '{"a": 1}'
+        assert mock_get.call_count == 1
+
+        # A new process revalidates the copy on disk
+        mock_get.return_value = Mock(status_code=304, headers={}, text='')
+        disk_cached_get_text.cache_clear()
+        assert disk_cached_get_text(url, cache_dir) == '{"a": 1}'
+        mock_get.assert_called_with(url, headers={'If-None-Match': '"abc"',
+                                                  'If-Modified-Since': 'Mon, 04 Jun 2018 10:00:00 GMT'})
+
+        mock_get.side_effect = requests.exceptions.ConnectionError
+        disk_cached_get_text.cache_clear()
+        assert disk_cached_get_text(url, cache_dir) == '{"a": 1}'
+
+        disk_cached_get_text.cache_clear()
+        with pytest.raises(requests.exceptions.ConnectionError):
+            disk_cached_get_text('http://example.com/other.json', cache_dir)
+
+        # Without a copy, an error is raised, so the error page isn't cached
+        mock_get.side_effect = None
+        mock_get.return_value = Mock(status_code=503, headers={}, text='<html>Unavailable</html>')
+        mock_get.return_value.raise_for_status.side_effect = requests.exceptions.HTTPError
+        with pytest.raises(requests.exceptions.HTTPError):
+            disk_cached_get_text('http://example.com/other.json', cache_dir)
+        mock_get.return_value = Mock(status_code=200, headers={}, text='{"b": 2}')
+        assert disk_cached_get_text('http://example.com/other.json', cache_dir) == '{"b": 2}'
+        assert sorted(os.listdir(cache_dir)) == sorted([
+            hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json',
+            hashlib.sha256(b'http://example.com/other.json').hexdigest() + '.json',
+        ])
+    disk_cached_get_text.cache_clear()
+
+
+def test_unique_ids():
+    schema_validator = validator({'type': 'array', 'uniqueItems': True})
+
+    errors = list(schema_validator.iter_errors([{'id': 'b'}, {'id': 'a'}, {'id': 'b'}, {'id': 'c'},
+                                                {'id': 'a'}, {'id': 'd'}, {'id': 'd'}, {'id': 'c'}]))
+    assert [error.message for error in errors] == ['Non-unique ID Values (first 3 shown):  b, a, d']
+
+    assert not list(schema_validator.iter_errors([{'id': 'a'}, {'id': 'b'}]))
+
+    # Without an id on every item, the standard check is used
+    errors = list(schema_validator.iter_errors([{'id': 'a'}, {'id': 'a'}, {'title': 'x'}]))
+    assert [error.validator for error in errors] == ['uniqueItems']
+    assert 'non-unique elements' in errors[0].message
@@ -14,3 +14,4 @@ class Schema360(SchemaJsonMixin):
     release_pkg_schema_name = config['schema_name']
     release_schema_url = urljoin(schema_host, release_schema_name)
     release_pkg_schema_url = urljoin(schema_host, release_pkg_schema_name)
+    schema_cache_dir = settings.SCHEMA_CACHE_DIR
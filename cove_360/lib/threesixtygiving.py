@@ -1,13 +1,20 @@
+import json
+import os
 import re
-from collections import defaultdict, OrderedDict
+from collections import defaultdict
 from decimal import Decimal
 
+from django.conf import settings
+from django.core.cache import cache
+
 import cove.lib.tools as tools
-from cove.lib.common import common_checks_context, get_orgids_prefixes
+from cove.lib.common import common_checks_context, get_cached_schema_validator, get_orgids_prefixes
 
 
 orgids_prefixes = get_orgids_prefixes()
 orgids_prefixes.append('360G')
+# For str.startswith, which takes a tuple of prefixes
+orgids_prefixes_lower = tuple(prefix.lower() for prefix in orgids_prefixes)
 
 currency_html = {
     "GBP": "&pound;",
@@ -18,6 +25,10 @@ currency_html = {
 
 @tools.ignore_errors
 def get_grants_aggregates(json_data):
+    '''Aggregate values over json_data['grants'] in a single pass.
+
+    The grants may be any iterable, including a one-shot iterator of grant
+    dicts from a streaming parser.'''
 
     id_count = 0
     count = 0
@@ -30,12 +41,17 @@ def get_grants_aggregates(json_data):
     currencies = {}
 
     if 'grants' in json_data:
+        add_unique_id = unique_ids.add
+        add_funding_org_id = distinct_funding_org_identifier.add
+        add_recipient_org_id = distinct_recipient_org_identifier.add
+
         for grant in json_data['grants']:
-            count = count + 1
+            count += 1
             currency = grant.get('currency')
 
-            if currency not in currencies.keys():
-                currencies[currency] = {
+            currency_aggregates = currencies.get(currency)
+            if currency_aggregates is None:
+                currency_aggregates = currencies[currency] = {
                     "count": 0,
                     "total_amount": 0,
                     "max_amount": 0,
@@ -43,40 +59,40 @@ def get_grants_aggregates(json_data):
                     "currency_symbol": currency_html.get(currency, "")
                 }
 
-            currencies[currency]["count"] += 1
+            currency_aggregates["count"] += 1
             amount_awarded = grant.get('amountAwarded')
             if amount_awarded and isinstance(amount_awarded, (int, Decimal, float)):
-                currencies[currency]["total_amount"] += amount_awarded
-                currencies[currency]['max_amount'] = max(amount_awarded, currencies[currency]['max_amount'])
-                if not currencies[currency]["min_amount"]:
-                    currencies[currency]['min_amount'] = amount_awarded
-                currencies[currency]['min_amount'] = min(amount_awarded, currencies[currency]['min_amount'])
+                currency_aggregates["total_amount"] += amount_awarded
+                # These comparisons match what max() and min() would return
+                if not currency_aggregates['max_amount'] > amount_awarded:
+                    currency_aggregates['max_amount'] = amount_awarded
+                min_amount = currency_aggregates['min_amount']
+                if not min_amount or not min_amount < amount_awarded:
+                    currency_aggregates['min_amount'] = amount_awarded
 
             award_date = str(grant.get('awardDate', ''))
             if award_date:
-                max_award_date = max(award_date, max_award_date)
-                if not min_award_date:
+                if award_date > max_award_date:
+                    max_award_date = award_date
+                if not min_award_date or award_date < min_award_date:
                     min_award_date = award_date
-                min_award_date = min(award_date, min_award_date)
 
             grant_id = grant.get('id')
             if grant_id:
-                id_count = id_count + 1
+                id_count += 1
                 if grant_id in unique_ids:
                     duplicate_ids.add(grant_id)
-                unique_ids.add(grant_id)
+                add_unique_id(grant_id)
 
-            funding_orgs = grant.get('fundingOrganization', [])
-            for funding_org in funding_orgs:
+            for funding_org in grant.get('fundingOrganization', []):
                 funding_org_id = funding_org.get('id')
                 if funding_org_id:
-                    distinct_funding_org_identifier.add(funding_org_id)
+                    add_funding_org_id(funding_org_id)
 
-            recipient_orgs = grant.get('recipientOrganization', [])
-            for recipient_org in recipient_orgs:
+            for recipient_org in grant.get('recipientOrganization', []):
                 recipient_org_id = recipient_org.get('id')
                 if recipient_org_id:
-                    distinct_recipient_org_identifier.add(recipient_org_id)
+                    add_recipient_org_id(recipient_org_id)
 
     recipient_org_prefixes = get_prefixes(distinct_recipient_org_identifier)
     recipient_org_identifier_prefixes = recipient_org_prefixes['prefixes']
@@ -103,20 +119,57 @@ def get_grants_aggregates(json_data):
     }
 
 
-def common_checks_360(context, upload_dir, json_data, schema_obj):
+CHECKS_CACHE_TIMEOUT = 3600
+
+
+def get_validator_360(schema_obj):
+    return get_cached_schema_validator(schema_obj, schema_obj.release_pkg_schema_name,
+                                       fast=settings.USE_FAST_VALIDATOR)
+
+
+def _run_checks_360(file_type, upload_dir, json_data, schema_obj):
     schema_name = schema_obj.release_pkg_schema_name
-    common_checks = common_checks_context(upload_dir, json_data, schema_obj, schema_name, context)
+    common_checks = common_checks_context(upload_dir, json_data, schema_obj, schema_name, {'file_type': file_type},
+                                          schema_validator=get_validator_360(schema_obj))
     cell_source_map = common_checks['cell_source_map']
     additional_checks = run_additional_checks(json_data, cell_source_map, ignore_errors=True, return_on_error=None)
 
-    context.update(common_checks['context'])
-    context.update({
+    checks_context = common_checks['context']
+    # The templates don't use json_data, and it shouldn't be cached
+    checks_context.pop('json_data', None)
+    checks_context.update({
         'grants_aggregates': get_grants_aggregates(json_data, ignore_errors=True),
         'additional_checks_errored': additional_checks is None,
         'additional_checks': additional_checks,
-        'additional_checks_count': (len(additional_checks) if additional_checks else 0) + (1 if context['data_only'] else 0),
+        'additional_checks_count': (len(additional_checks) if additional_checks else 0) + (1 if checks_context['data_only'] else 0),
         'common_error_types': ['uri', 'date-time', 'required', 'enum', 'number', 'string']
     })
+    return checks_context
+
+
+def common_checks_360(context, upload_dir, json_data, schema_obj, cache_key=None):
+    '''Run the common and 360Giving specific checks and add the results to context.
+
+    If cache_key is given, the results are kept in Django's cache under that
+    key, so that viewing the same data again does not re-run the checks. See
+    CACHES in cove/settings.py for whether that cache is shared between
+    processes.'''
+    def run_checks():
+        return _run_checks_360(context['file_type'], upload_dir, json_data, schema_obj)
+
+    if cache_key:
+        checks_context = cache.get_or_set(cache_key, run_checks, CHECKS_CACHE_TIMEOUT)
+        # If the results came from the cache for another upload of the same data,
+        # this upload's directory still needs the validation errors file
+        validation_errors_path = os.path.join(upload_dir, 'validation_errors-3.json')
+        if not os.path.exists(validation_errors_path):
+            with open(validation_errors_path, 'w+') as validation_error_fp:
+                json.dump(dict(checks_context['validation_errors']), validation_error_fp,
+                          sort_keys=True, indent=2, default=tools.decimal_default)
+    else:
+        checks_context = run_checks()
+
+    context.update(checks_context)
 
     return context
 
@@ -167,34 +220,36 @@ def check_company_number(company_number):
 
 def flatten_dict(grant, path=""):
     for key, value in sorted(grant.items()):
+        key_path = path + '/' + str(key)
         if isinstance(value, list):
             for num, item in enumerate(value):
                 if isinstance(item, dict):
-                    yield from flatten_dict(item, "{}/{}/{}".format(path, key, num))
+                    yield from flatten_dict(item, key_path + '/' + str(num))
                 else:
-                    yield ("{}/{}/{}".format(path, key, num), item)
+                    yield (key_path + '/' + str(num), item)
         elif isinstance(value, dict):
-            yield from flatten_dict(value, "{}/{}".format(path, key))
+            yield from flatten_dict(value, key_path)
         else:
-            yield ("{}/{}".format(path, key), value)
+            yield (key_path, value)
 
 
 class AdditionalTest():
+    # Verb used by format_heading_count to build the heading
+    heading_verb = 'have'
+
     def __init__(self, **kw):
         self.grants = kw['grants']
         self.json_locations = []
         self.failed = False
         self.count = 0
-        self.heading = None
-        self.message = None
 
     def process(self, grant, path_prefix):
         pass
 
     def produce_message(self):
         return {
-            'heading': self.heading,
-            'message': self.message
+            'heading': self.format_heading_count(self.check_text['heading'], verb=self.heading_verb),
+            'message': self.check_text['message']
         }
 
     def format_heading_count(self, message, verb='have'):
@@ -237,9 +292,6 @@ class ZeroAmountTest(AdditionalTest):
         except KeyError:
             pass
 
-        self.heading = self.format_heading_count(self.check_text['heading'])
-        self.message = self.check_text['message']
-
 
 class RecipientOrg360GPrefix(AdditionalTest):
     """Check if any grants are using RecipientOrg IDs that start 360G or 360g"""
@@ -259,9 +311,6 @@ class RecipientOrg360GPrefix(AdditionalTest):
         except KeyError:
             pass
 
-        self.heading = self.format_heading_count(self.check_text['heading'])
-        self.message = self.check_text['message']
-
 
 class FundingOrg360GPrefix(AdditionalTest):
     """Check if any grants are using FundingOrg IDs that start 360G or 360g"""
@@ -281,9 +330,6 @@ class FundingOrg360GPrefix(AdditionalTest):
         except KeyError:
             pass
 
-        self.heading = self.format_heading_count(self.check_text['heading'])
-        self.message = self.check_text['message']
-
 
 class RecipientOrgUnrecognisedPrefix(AdditionalTest):
     """Check if any grants have RecipientOrg IDs that use a prefix that isn't on the Org ID prefix codelist"""
@@ -297,10 +343,7 @@ class RecipientOrgUnrecognisedPrefix(AdditionalTest):
         try:
             count_failure = False
             for num, organization in enumerate(grant['recipientOrganization']):
-                for prefix in orgids_prefixes:
-                    if organization['id'].lower().startswith(prefix.lower()):
-                        break
-                else:
+                if not organization['id'].lower().startswith(orgids_prefixes_lower):
                     self.failed = True
                     count_failure = True
                     self.json_locations.append(path_prefix + '/recipientOrganization/{}/id'.format(num))
@@ -310,9 +353,6 @@ class RecipientOrgUnrecognisedPrefix(AdditionalTest):
         except KeyError:
             pass
 
-        self.heading = self.format_heading_count(self.check_text['heading'])
-        self.message = self.check_text['message']
-
 
 class FundingOrgUnrecognisedPrefix(AdditionalTest):
     """Check if any grants have FundingOrg IDs that use a prefix that isn't on the Org ID prefix codelist"""
@@ -326,10 +366,7 @@ class FundingOrgUnrecognisedPrefix(AdditionalTest):
         try:
             count_failure = False
             for num, organization in enumerate(grant['fundingOrganization']):
-                for prefix in orgids_prefixes:
-                    if organization['id'].lower().startswith(prefix.lower()):
-                        break
-                else:
+                if not organization['id'].lower().startswith(orgids_prefixes_lower):
                     self.failed = True
                     count_failure = True
                     self.json_locations.append(path_prefix + '/fundingOrganization/{}/id'.format(num))
@@ -339,9 +376,6 @@ class FundingOrgUnrecognisedPrefix(AdditionalTest):
         except KeyError:
             pass
 
-        self.heading = self.format_heading_count(self.check_text['heading'])
-        self.message = self.check_text['message']
-
 
 class RecipientOrgCharityNumber(AdditionalTest):
     """Check if any grants have RecipientOrg charity numbers that don't look like charity numbers
@@ -372,9 +406,6 @@ class RecipientOrgCharityNumber(AdditionalTest):
         except KeyError:
             pass
 
-        self.heading = self.format_heading_count(self.check_text['heading'])
-        self.message = self.check_text['message']
-
 
 class RecipientOrgCompanyNumber(AdditionalTest):
     """Checks if any grants have RecipientOrg company numbers that don't look like company numbers
@@ -402,13 +433,12 @@ class RecipientOrgCompanyNumber(AdditionalTest):
         except KeyError:
             pass
 
-        self.heading = self.format_heading_count(self.check_text['heading'])
-        self.message = self.check_text['message']
-
 
 class NoRecipientOrgCompanyCharityNumber(AdditionalTest):
     """Checks if any grants don't have either a Recipient Org:Company Number or Recipient Org:Charity Number"""
 
+    heading_verb = 'do'
+
     check_text = {
         "heading": "not have either a Recipient Org:Company Number or a Recipient Org:Charity Number",
         "message": "Providing one or both of these, if possible, makes it easier for users to join up your data with other data sources to provide better insight into grantmaking. If your grants are to organisations that don’t have UK Company or UK Charity numbers, then you can ignore this notice."
@@ -429,13 +459,12 @@ class NoRecipientOrgCompanyCharityNumber(AdditionalTest):
         except KeyError:
             pass
 
-        self.heading = self.format_heading_count(self.check_text['heading'], verb="do")
-        self.message = self.check_text['message']
-
 
 class IncompleteRecipientOrg(AdditionalTest):
     """Checks if any grants lack one of either Recipient Org:Postal Code or both of Recipient Org:Location:Geographic Code and Recipient Org:Location:Geographic Code Type"""
 
+    heading_verb = 'do'
+
     check_text = {
         "heading": "not have recipient organisation location information",
         "message": "Your data is missing information about the geographic location of recipient organisations; either Recipient Org:Postal Code or Recipient Org:Location:Geographic Code combined with Recipient Org:Location:Geographic Code Type. Knowing the geographic location of recipient organisations helps users to understand your data and allows it to be used in tools that visualise grants geographically."
@@ -461,9 +490,6 @@ class IncompleteRecipientOrg(AdditionalTest):
         except KeyError:
             pass
 
-        self.heading = self.format_heading_count(self.check_text['heading'], verb="do")
-        self.message = self.check_text['message']
-
 
 class MoreThanOneFundingOrg(AdditionalTest):
     """Checks if the file contains multiple FundingOrganisation:IDs"""
@@ -475,21 +501,24 @@ class MoreThanOneFundingOrg(AdditionalTest):
 
     def __init__(self, **kw):
         super().__init__(**kw)
-        self.funding_organization_ids = []
+        self.funding_organization_ids = set()
 
     def process(self, grant, path_prefix):
         try:
             for num, organization in enumerate(grant['fundingOrganization']):
                 if organization.get('id') and organization.get('id') not in self.funding_organization_ids:
-                    self.funding_organization_ids.append(organization['id'])
+                    self.funding_organization_ids.add(organization['id'])
                     self.json_locations.append(path_prefix + '/fundingOrganization/{}/id'.format(num))
         except KeyError:
             pass
         if len(self.funding_organization_ids) > 1:
             self.failed = True
 
-        self.heading = self.check_text["heading"].format(len(self.funding_organization_ids))
-        self.message = self.check_text["message"]
+    def produce_message(self):
+        return {
+            'heading': self.check_text["heading"].format(len(self.funding_organization_ids)),
+            'message': self.check_text["message"]
+        }
 
 
 compiled_email_re = re.compile('[\w.-]+@[\w.-]+\.[\w.-]+')
@@ -501,26 +530,27 @@ class LooksLikeEmail(AdditionalTest):
     The check looks for any number of alphanumerics, dots or hyphens, followed by an @ sign, followed by any number of alphanumerics, dots or hyphens, with a minimum of one dot after the @
     """
 
+    heading_verb = 'contain'
+
     check_text = {
         "heading": "text that looks like an email address",
         "message": "Your data may contain an email address (or something that looks like one), which can constitute personal data. The use and distribution of personal data is restricted by the Data Protection Act. You should ensure that any personal data is only included with the knowledge and consent of the person to whom it refers."
     }
 
     def process(self, grant, path_prefix):
-        flattened_grant = OrderedDict(flatten_dict(grant))
-        for key, value in flattened_grant.items():
-            if isinstance(value, str) and compiled_email_re.search(value):
+        for key, value in flatten_dict(grant):
+            # Checking for '@' first is much quicker than the regex, which needs one anyway
+            if isinstance(value, str) and '@' in value and compiled_email_re.search(value):
                 self.failed = True
                 self.json_locations.append(path_prefix + key)
                 self.count += 1
 
-        self.heading = self.format_heading_count(self.check_text['heading'], verb='contain')
-        self.message = self.check_text['message']
-
 
 class NoGrantProgramme(AdditionalTest):
     """Checks if any grants have no Grant Programme fields"""
 
+    heading_verb = 'do'
+
     check_text = {
         "heading": "not contain any Grant Programme fields",
         "message": "Providing Grant Programme data, if available, helps users to better understand your data."
@@ -533,13 +563,12 @@ class NoGrantProgramme(AdditionalTest):
             self.count += 1
             self.json_locations.append(path_prefix + '/id')
 
-        self.heading = self.format_heading_count(self.check_text['heading'], verb='do')
-        self.message = self.check_text['message']
-
 
 class NoBeneficiaryLocation(AdditionalTest):
     """Checks if any grants have no Beneficiary Location fields"""
 
+    heading_verb = 'do'
+
     check_text = {
         "heading": "not contain any beneficiary location fields",
         "message": "Providing beneficiary data, if available, helps users to understand which areas ultimately benefitted from the grant."
@@ -552,9 +581,6 @@ class NoBeneficiaryLocation(AdditionalTest):
             self.count += 1
             self.json_locations.append(path_prefix + '/id')
 
-        self.heading = self.format_heading_count(self.check_text['heading'], verb='do')
-        self.message = self.check_text['message']
-
 
 class TitleDescriptionSame(AdditionalTest):
     """Checks if any grants have the same text for Title and Description"""
@@ -572,9 +598,6 @@ class TitleDescriptionSame(AdditionalTest):
             self.count += 1
             self.json_locations.append(path_prefix + '/description')
 
-        self.heading = self.format_heading_count(self.check_text['heading'])
-        self.message = self.check_text['message']
-
 
 class TitleLength(AdditionalTest):
     """Checks if any grants have Titles longer than 140 characters"""
@@ -591,9 +614,6 @@ class TitleLength(AdditionalTest):
             self.count += 1
             self.json_locations.append(path_prefix + '/title')
 
-        self.heading = self.format_heading_count(self.check_text['heading'])
-        self.message = self.check_text['message']
-
 
 class OrganizationIdLooksInvalid(AdditionalTest):
     """Checks if any grants have org IDs for fundingOrg or recipientOrg that don't look correctly formatted for their respective registration agency (eg GB-CHC- not looking like a valid company number)
@@ -625,13 +645,12 @@ class OrganizationIdLooksInvalid(AdditionalTest):
                         self.json_locations.append(id_location)
                         self.count += 1
 
-        self.heading = self.format_heading_count(self.check_text['heading'])
-        self.message = self.check_text['message']
-
 
 class NoLastModified(AdditionalTest):
     """Check if any grants are missing Last Modified dates"""
 
+    heading_verb = 'do'
+
     check_text = {
         "heading": "not have Last Modified information",
         "message": "Last Modified shows the date and time when information about a grant was last updated in your file. Including this information allows data users to see when changes have been made and reconcile differences between versions of your data. Please note: this is the date when the data was modified in your 360Giving file, rather than in any of your internal systems."
@@ -644,13 +663,12 @@ class NoLastModified(AdditionalTest):
             self.count += 1
             self.json_locations.append(path_prefix + '/id')
 
-        self.heading = self.format_heading_count(self.check_text['heading'], verb='do')
-        self.message = self.check_text['message']
-
 
 class NoDataSource(AdditionalTest):
     """Checks if any grants are missing dataSource"""
 
+    heading_verb = 'do'
+
     check_text = {
         "heading": "not have Data Source information",
         "message": "Data Source informs users about where information came from and is an important part of establishing trust in your data. This information should be a web link pointing to the source of this data, which may be an original 360Giving data file, a file from which the data was converted, or your organisation’s website."
@@ -663,9 +681,6 @@ class NoDataSource(AdditionalTest):
             self.count += 1
             self.json_locations.append(path_prefix + '/id')
 
-        self.heading = self.format_heading_count(self.check_text['heading'], verb='do')
-        self.message = self.check_text['message']
-
 
 # class IncompleteBeneficiaryLocation(AdditionalTest):
 #     """Checks if any grants that do have Beneficiary Location fields are missing any of the details"""
@@ -715,13 +730,19 @@ TEST_CLASSES = [
 
 @tools.ignore_errors
 def run_additional_checks(json_data, cell_source_map):
+    '''Run TEST_CLASSES over json_data['grants'] in a single pass.
+
+    As with get_grants_aggregates, the grants may be a one-shot iterator.
+    '''
     if 'grants' not in json_data:
         return []
     test_instances = [test_cls(grants=json_data['grants']) for test_cls in TEST_CLASSES]
+    processes = [test_instance.process for test_instance in test_instances]
 
     for num, grant in enumerate(json_data['grants']):
-        for test_instance in test_instances:
-            test_instance.process(grant, 'grants/{}'.format(num))
+        path_prefix = 'grants/' + str(num)
+        for process in processes:
+            process(grant, path_prefix)
 
     results = []
 
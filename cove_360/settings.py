@@ -23,6 +23,9 @@ STATIC_ROOT = settings.STATIC_ROOT
 LANGUAGES = settings.LANGUAGES
 LOCALE_PATHS = settings.LOCALE_PATHS
 LOGGING = settings.LOGGING
+USE_FAST_VALIDATOR = settings.USE_FAST_VALIDATOR
+SCHEMA_CACHE_DIR = settings.SCHEMA_CACHE_DIR
+CACHES = settings.CACHES
 
 if getattr(settings, 'RAVEN_CONFIG', None):
     RAVEN_CONFIG = settings.RAVEN_CONFIG
@@ -1,13 +1,21 @@
+import hashlib
+import io
+import json
 import os
+from decimal import Decimal
+from unittest.mock import Mock, patch
 
 import pytest
+import requests
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import UploadedFile
 
 from . lib.schema import Schema360
-from . lib.threesixtygiving import run_additional_checks
+from . lib.threesixtygiving import get_grants_aggregates, get_validator_360, run_additional_checks
+from . views import _get_schema_360, load_json
 from cove.input.models import SuppliedData
+from cove.lib.common import FastValidator, get_schema_validator
 
 # Source is cove_360/fixtures/fundingproviders-grants_fixed_2_grants.json
 # see cove_360/fixtures/SOURCES for more info.
@@ -486,6 +494,78 @@ def test_explore_page_convert(client):
     assert 'converted_file_size_titles' in resp.context
 
 
+@pytest.mark.django_db
+def test_explore_page_checks_cached(client):
+    data = SuppliedData.objects.create()
+    data.original_file.save('test.json', ContentFile('{"grants": [{"id": "a"}]}'))
+    data.current_app = 'cove_360'
+    resp = client.get(data.get_absolute_url())
+    assert resp.status_code == 200
+    assert resp.context['grants_aggregates']['count'] == 1
+
+    with patch('cove_360.lib.threesixtygiving.common_checks_context') as mock_common_checks:
+        resp = client.get(data.get_absolute_url())
+    assert resp.status_code == 200
+    assert not mock_common_checks.called
+    assert resp.context['grants_aggregates']['count'] == 1
+    assert 'json_data' not in resp.context
+    assert resp.context['grants'] == [{'id': 'a'}]
+
+
+@pytest.mark.django_db
+def test_explore_page_first_render(client):
+    data = SuppliedData.objects.create()
+    data.original_file.save('test.json', ContentFile('{"grants": [{"id": "d"}]}'))
+    data.current_app = 'cove_360'
+    resp = client.get(data.get_absolute_url())
+    assert resp.context['first_render']
+    data.refresh_from_db()
+    assert data.rendered
+
+    with patch('cove.input.models.SuppliedData.save') as mock_save:
+        resp = client.get(data.get_absolute_url())
+    assert not resp.context['first_render']
+    assert not mock_save.called
+
+
+@pytest.mark.django_db
+def test_explore_page_checks_cached_by_content(client):
+    data = SuppliedData.objects.create()
+    data.original_file.save('test.json', ContentFile('{"grants": [{"id": "b"}, {"id": "c"}]}'))
+    data.current_app = 'cove_360'
+    resp = client.get(data.get_absolute_url())
+    assert resp.status_code == 200
+    assert resp.context['grants_aggregates']['count'] == 2
+
+    same_data = SuppliedData.objects.create()
+    same_data.original_file.save('test.json', ContentFile('{"grants": [{"id": "b"}, {"id": "c"}]}'))
+    same_data.current_app = 'cove_360'
+    with patch('cove_360.lib.threesixtygiving.common_checks_context') as mock_common_checks:
+        resp = client.get(same_data.get_absolute_url())
+    assert resp.status_code == 200
+    assert not mock_common_checks.called
+    assert resp.context['grants_aggregates']['count'] == 2
+    with open(os.path.join(same_data.upload_dir(), 'validation_errors-3.json')) as fp:
+        assert sorted(json.load(fp)) == [key for key, _ in resp.context['validation_errors']]
+
+
+@pytest.mark.django_db
+def test_explore_page_file_digest_stored(client):
+    content = b'{"grants": [{"id": "b"}]}'
+    data = SuppliedData.objects.create()
+    data.original_file.save('test.json', ContentFile(content))
+    data.current_app = 'cove_360'
+    resp = client.get(data.get_absolute_url())
+    assert resp.status_code == 200
+    data.refresh_from_db()
+    assert data.file_digest == hashlib.sha256(content).hexdigest()
+
+    with patch('cove_360.views.file_digest') as mock_file_digest:
+        resp = client.get(data.get_absolute_url())
+    assert resp.status_code == 200
+    assert not mock_file_digest.called
+
+
 @pytest.mark.django_db
 def test_explore_page_csv(client):
     data = SuppliedData.objects.create()
@@ -535,5 +615,113 @@ def test_schema_360():
     assert schema.release_pkg_schema_url == settings.COVE_CONFIG['schema_host'] + settings.COVE_CONFIG['schema_name']
 
 
+def test_schema_360_shared():
+    schema = _get_schema_360()
+    assert isinstance(schema, Schema360)
+    assert _get_schema_360() is schema
+
+
+def test_validator_360_reused():
+    schema = _get_schema_360()
+    assert get_validator_360(schema) is get_validator_360(schema)
+
+
+def test_schema_fetch_error_not_kept():
+    schema = Schema360()
+    schema.schema_cache_dir = ''
+    with patch('cove.lib.common.requests.get') as mock_get:
+        mock_get.return_value.raise_for_status.side_effect = requests.exceptions.HTTPError('404')
+        with pytest.raises(requests.exceptions.HTTPError):
+            schema.release_pkg_schema_str
+        mock_get.return_value = Mock(text='{}')
+        assert schema.release_pkg_schema_str == '{}'
+
+
+VALID_GRANT = {
+    'id': '360G-xxx-1',
+    'title': 'Grant title',
+    'description': 'Grant description',
+    'currency': 'GBP',
+    'amountAwarded': 1000,
+    'awardDate': '2014-07-24T00:00:00+00:00',
+    'recipientOrganization': [{'id': 'GB-CHC-1234', 'name': 'Recipient'}],
+    'fundingOrganization': [{'id': 'GB-CHC-5678', 'name': 'Funder'}],
+}
+
+
+@pytest.mark.parametrize('json_data', [
+    {'grants': [VALID_GRANT]},
+    {'grants': [VALID_GRANT, dict(VALID_GRANT, title='Another grant')]},
+    {'grants': [dict(VALID_GRANT, amountAwarded=Decimal('1000.5'), awardDate='24/07/2014')]},
+    GRANTS,
+    {},
+])
+def test_fast_validator_360(json_data):
+    schema = _get_schema_360()
+    schema_validator = get_schema_validator(schema, schema.release_pkg_schema_name)
+    fast_validator = FastValidator(schema, schema.release_pkg_schema_name, schema_validator)
+    expected = [(e.message, list(e.path)) for e in schema_validator.iter_errors(json_data)]
+    assert [(e.message, list(e.path)) for e in fast_validator.iter_errors(json_data)] == expected
+
+
 def test_additional_checks():
     assert run_additional_checks(GRANTS, SOURCE_MAP) == RESULTS
+
+
+def test_grants_iterator():
+    grants_iterator = {'grants': iter(GRANTS['grants'])}
+    assert run_additional_checks(grants_iterator, SOURCE_MAP) == RESULTS
+    grants_iterator = {'grants': iter(GRANTS['grants'])}
+    assert get_grants_aggregates(grants_iterator) == get_grants_aggregates(GRANTS)
+
+
+@pytest.mark.parametrize(('json_data', 'expected'), [
+    ('{"grants": [{"amountAwarded": 1000.1}, {"amountAwarded": 10}]}',
+     {'grants': [{'amountAwarded': Decimal('1000.1')}, {'amountAwarded': 10}]}),
+    ('{"a": [0.5, [1.25, {"b": 2.0}]]}', {'a': [Decimal('0.5'), [Decimal('1.25'), {'b': Decimal('2.0')}]]}),
+    ('[1.5]', [Decimal('1.5')]),
+    ('1.5', Decimal('1.5')),
+    ('{"grants": [{"amountAwarded": 10}]}', {'grants': [{'amountAwarded': 10}]}),
+])
+def test_load_json(json_data, expected):
+    assert load_json(io.BytesIO(json_data.encode('utf-8'))) == expected
+
+
+def test_load_json_keeps_number_text():
+    json_data = load_json(io.BytesIO(b'{"grants": [{"amountAwarded": 1000.50}, {"amountAwarded": 12345678901234567890.12}]}'))
+    assert [str(grant['amountAwarded']) for grant in json_data['grants']] == ['1000.50', '12345678901234567890.12']
+
+
+@pytest.mark.django_db
+def test_explore_page_amounts(client):
+    data = SuppliedData.objects.create()
+    data.original_file.save('test.json', ContentFile(
+        '{"grants": [{"id": "a", "currency": "GBP", "amountAwarded": 1000.50},'
+        ' {"id": "b", "currency": "GBP", "amountAwarded": 2.50}]}'))
+    data.current_app = 'cove_360'
+    resp = client.get(data.get_absolute_url())
+    assert resp.status_code == 200
+    assert resp.context['grants_aggregates']['currencies']['GBP']['total_amount'] == Decimal('1003.00')
+    content = resp.content.decode('utf-8')
+    assert '&pound;1,003.00' in content
+    assert '<td>1000.50</td>' in content
+
+
+def test_load_json_malformed():
+    with pytest.raises(ValueError):
+        load_json(io.BytesIO(b'{"grants": ['))
+
+
+@pytest.mark.parametrize(('json_data', 'expected'), [
+    (b'{"grants": [{"amountAwarded": 1000.1}]}', {'grants': [{'amountAwarded': Decimal('1000.1')}]}),
+    (b'', None),
+])
+def test_load_json_file(tmpdir, json_data, expected):
+    json_file = tmpdir.join('test.json')
+    json_file.write_binary(json_data)
+    with open(str(json_file), 'rb') as fp:
+        if expected is None:
+            with pytest.raises(ValueError):
+                load_json(fp)
+        else:
+            assert load_json(fp) == expected
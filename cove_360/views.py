@@ -1,5 +1,8 @@
+import hashlib
 import json
 import logging
+import mmap
+import threading
 from decimal import Decimal
 
 from django.shortcuts import render
@@ -14,10 +17,57 @@ from cove.views import explore_data_context
 
 logger = logging.getLogger(__name__)
 
+# The grants table in explore.html shows at most this many grants
+GRANTS_TABLE_LIMIT = 5000
+
+_SCHEMA_360 = None
+_SCHEMA_360_LOCK = threading.Lock()
+
+
+def _get_schema_360():
+    '''Return a Schema360 shared between requests.
+
+    Schema360 holds no per-request state, and sharing it means the schema
+    strings it fetches (cached_property) are downloaded once per process
+    rather than on every explore request.'''
+    global _SCHEMA_360
+    if _SCHEMA_360 is None:
+        with _SCHEMA_360_LOCK:
+            if _SCHEMA_360 is None:
+                _SCHEMA_360 = Schema360()
+    return _SCHEMA_360
+
+
+def file_digest(file_name):
+    '''Return the sha256 hex digest of a file's contents.'''
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_json(fp):
+    '''Parse JSON from a file opened in binary mode, with floats as Decimal.
+
+    Decimals keep the number as written, e.g. 1000.50, which is what the
+    amounts, their totals and the grants table show. orjson can only give
+    floats, so the standard library parses the whole file once instead.
+
+    Files on disk are memory mapped, so large uploads are decoded straight
+    from the page cache rather than first being read into a bytes object.'''
+    try:
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # Not a real file (e.g. BytesIO), or an empty one, which can't be mapped
+        return json.loads(str(fp.read(), 'utf-8'), parse_float=Decimal)
+    with mapped:
+        return json.loads(str(mapped, 'utf-8'), parse_float=Decimal)
+
 
 @cove_web_input_error
 def explore_360(request, pk, template='cove_360/explore.html'):
-    schema_360 = Schema360()
+    schema_360 = _get_schema_360()
     context, db_data, error = explore_data_context(request, pk)
     if error:
         return error
@@ -29,9 +79,9 @@ def explore_360(request, pk, template='cove_360/explore.html'):
 
     if file_type == 'json':
         # open the data first so we can inspect for record package
-        with open(file_name, encoding='utf-8') as fp:
+        with open(file_name, 'rb') as fp:
             try:
-                json_data = json.load(fp, parse_float=Decimal)
+                json_data = load_json(fp)
             except ValueError as err:
                 raise CoveInputDataError(context={
                     'sub_title': _("Sorry, we can't process that data"),
@@ -55,21 +105,41 @@ def explore_360(request, pk, template='cove_360/explore.html'):
 
     else:
         context.update(convert_spreadsheet(upload_dir, upload_url, file_name, file_type, schema_360.release_schema_url, schema_360.release_pkg_schema_url))
-        with open(context['converted_path'], encoding='utf-8') as fp:
-            json_data = json.load(fp, parse_float=Decimal)
-
-    context = common_checks_360(context, upload_dir, json_data, schema_360)
+        # flattentool.unflatten only writes its output to converted_path (which
+        # is also the converted file users download), so read it back here.
+        with open(context['converted_path'], 'rb') as fp:
+            json_data = load_json(fp)
+
+    # The checks only depend on the uploaded file's contents (spreadsheets are
+    # converted from it), so the same data uploaded again reuses the results.
+    if not db_data.file_digest:
+        db_data.file_digest = file_digest(file_name)
+        db_data.save()
+    checks_cache_key = 'cove_360_checks:{}:{}:{}'.format(
+        file_type, schema_360.release_pkg_schema_url, db_data.file_digest)
+    context = common_checks_360(context, upload_dir, json_data, schema_360, cache_key=checks_cache_key)
 
     if hasattr(json_data, 'get') and hasattr(json_data.get('grants'), '__iter__'):
-        context['grants'] = json_data['grants']
+        grants = json_data['grants']
+        if isinstance(grants, list):
+            grants = grants[:GRANTS_TABLE_LIMIT]
+        context['grants'] = grants
     else:
         context['grants'] = []
+    # Only the grants shown in the table are needed from here on, so let the
+    # rest of the data be freed before the page is rendered.
+    del json_data
 
     context['first_render'] = not db_data.rendered
+    # Nothing else on db_data changes here, so repeat views don't need to write
     if not db_data.rendered:
         db_data.rendered = True
-    db_data.save()
+        db_data.save()
 
+    # This is rendered in one go rather than streamed: the summary at the top
+    # of the page needs grants_aggregates, and CoveInputDataError has to be
+    # raised before any of the response is sent for cove_web_input_error to
+    # show the error page.
     return render(request, template, context)
 
 
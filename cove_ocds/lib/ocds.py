@@ -3,8 +3,9 @@ import collections
 import re
 
 import cove.lib.tools as tools
-from cove.lib.common import common_checks_context, get_additional_codelist_values
+from cove.lib.common import common_checks_context, get_additional_codelist_values, get_cached_schema_validator
 
+from django.conf import settings
 from django.utils.html import mark_safe, escape, conditional_escape, format_html
 
 import CommonMark
@@ -377,7 +378,9 @@ def common_checks_ocds(context, upload_dir, json_data, schema_obj, api=False, ca
     if 'records' in json_data:
         schema_name = schema_obj.record_pkg_schema_name
     common_checks = common_checks_context(upload_dir, json_data, schema_obj, schema_name, context,
-                                          fields_regex=True, api=api, cache=cache)
+                                          fields_regex=True, api=api, cache=cache,
+                                          schema_validator=get_cached_schema_validator(schema_obj, schema_name,
+                                                                                       fast=settings.USE_FAST_VALIDATOR))
     validation_errors = common_checks['context']['validation_errors']
 
     new_validation_errors = []
@@ -3,8 +3,8 @@ import json
 from copy import deepcopy
 from urllib.parse import urljoin, urlparse
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-import json_merge_patch
 import requests
 from cached_property import cached_property
 from django.conf import settings
@@ -12,11 +12,32 @@ from django.utils import translation
 
 
 from cove.lib.common import SchemaJsonMixin, schema_dict_fields_generator, get_schema_codelist_paths, load_core_codelists, load_codelist
-from cove.lib.tools import cached_get_request
+from cove.lib.tools import cached_get_request, disk_cached_get_text, http_session, json_loads
 
 
 config = settings.COVE_CONFIG
 
+# Extension files are fetched in parallel, see apply_extensions
+EXTENSION_FETCH_WORKERS = 8
+
+
+def merge_patch(target, patch):
+    '''Apply patch to the target dict in place, as a JSON Merge Patch (RFC 7396).'''
+    if not isinstance(patch, dict):
+        return
+    stack = [(target, patch)]
+    while stack:
+        target, patch = stack.pop()
+        for key, value in patch.items():
+            if isinstance(value, dict):
+                if not isinstance(target.get(key), dict):
+                    target[key] = {}
+                stack.append((target[key], value))
+            elif value is None:
+                target.pop(key, None)
+            else:
+                target[key] = value
+
 
 class SchemaOCDS(SchemaJsonMixin):
     release_schema_name = config['schema_item_name']
@@ -25,6 +46,7 @@ class SchemaOCDS(SchemaJsonMixin):
     version_choices = config['schema_version_choices']
     default_version = config['schema_version']
     default_schema_host = version_choices[default_version][1]
+    schema_cache_dir = settings.SCHEMA_CACHE_DIR
 
     def __init__(self, select_version=None, release_data=None, cache_schema=False):
         '''Build the schema object using an specific OCDS schema version
@@ -55,6 +77,7 @@ class SchemaOCDS(SchemaJsonMixin):
         self.extended = False
         self.extended_schema_file = None
         self.extended_schema_url = None
+        self._deref_extended_release_schema_obj = None
         self.codelists = config['schema_codelists']['1.1']
 
         if select_version:
@@ -139,47 +162,72 @@ class SchemaOCDS(SchemaJsonMixin):
                     self.extended_codelists[codelist] = codelist_map
 
     def get_release_schema_obj(self, deref=False):
-        release_schema_obj = self._release_schema_obj
         if self.extended_schema_file:
             with open(self.extended_schema_file) as fp:
                 release_schema_obj = json.load(fp)
-        elif self.extensions:
-            release_schema_obj = deepcopy(self._release_schema_obj)
-            self.apply_extensions(release_schema_obj)
+        else:
+            release_schema_obj = self._release_schema_obj
+            if self.extensions:
+                self.apply_extensions(release_schema_obj)
         if deref:
             if self.extended:
-                extended_release_schema_str = json.dumps(release_schema_obj)
-                release_schema_obj = self.deref_schema(extended_release_schema_str)
+                # The extensions don't change once applied, so neither does this
+                if self._deref_extended_release_schema_obj is None:
+                    self._deref_extended_release_schema_obj = self.deref_schema_obj(release_schema_obj)
+                release_schema_obj = self._deref_extended_release_schema_obj
             else:
                 release_schema_obj = self.deref_schema(self.release_schema_str)
         return release_schema_obj
 
+    @cached_property
+    def _release_pkg_schema_obj_shared(self):
+        # Parsed once, so must not be changed, unlike _release_pkg_schema_obj
+        return self._release_pkg_schema_obj
+
     def get_release_pkg_schema_obj(self, deref=False, use_extensions=True):
-        package_schema_obj = deepcopy(self._release_pkg_schema_obj)
         if deref:
             if self.extended and use_extensions:
                 deref_release_schema_obj = self.get_release_schema_obj(deref=True)
+                # Only copy the objects down to the releases' items, which are replaced
+                shared_obj = self._release_pkg_schema_obj_shared
+                package_schema_obj = dict(shared_obj)
+                package_schema_obj['properties'] = dict(shared_obj['properties'])
+                package_schema_obj['properties']['releases'] = dict(shared_obj['properties']['releases'])
                 package_schema_obj['properties']['releases']['items'] = {}
-                release_pkg_schema_str = json.dumps(package_schema_obj)
-                package_schema_obj = self.deref_schema(release_pkg_schema_str)
+                package_schema_obj = self.deref_schema_obj(package_schema_obj)
                 package_schema_obj['properties']['releases']['items'].update(deref_release_schema_obj)
             else:
-                return self.deref_schema(self.release_pkg_schema_str)
-        return package_schema_obj
+                package_schema_obj = self.deref_schema(self.release_pkg_schema_str)
+            return package_schema_obj
+        return self._release_pkg_schema_obj
+
+    def _fetch(self, url):
+        '''GET url, returning the exception instead if the request fails.'''
+        try:
+            if self.cache_schema:
+                return cached_get_request(url)
+            return http_session.get(url)
+        except requests.exceptions.RequestException as err:
+            return err
 
     def apply_extensions(self, schema_obj):
         if not self.extensions:
             return
+        urls = []
+        for extensions_descriptor_url in self.extensions.keys():
+            i = extensions_descriptor_url.rfind('/')
+            urls.append('{}/{}'.format(extensions_descriptor_url[:i], 'release-schema.json'))
+            urls.append(extensions_descriptor_url)
+        # Fetch everything up front, the merging below has to happen in order
+        with ThreadPoolExecutor(max_workers=EXTENSION_FETCH_WORKERS) as executor:
+            responses = dict(zip(urls, executor.map(self._fetch, urls)))
+
         for extensions_descriptor_url in self.extensions.keys():
             i = extensions_descriptor_url.rfind('/')
             url = '{}/{}'.format(extensions_descriptor_url[:i], 'release-schema.json')
 
-            try:
-                if self.cache_schema:
-                    extension = cached_get_request(url)
-                else:
-                    extension = requests.get(url)
-            except requests.exceptions.RequestException:
+            extension = responses[url]
+            if isinstance(extension, requests.exceptions.RequestException):
                 self.invalid_extension[extensions_descriptor_url] = 'fetching failed'
                 continue
 
@@ -194,12 +242,11 @@ class SchemaOCDS(SchemaJsonMixin):
                                                                                     extension.reason.lower())
                 continue
 
-            schema_obj = json_merge_patch.merge(schema_obj, extension_data)
+            merge_patch(schema_obj, extension_data)
             try:
-                if self.cache_schema:
-                    response = cached_get_request(extensions_descriptor_url)
-                else:
-                    response = requests.get(extensions_descriptor_url)
+                response = responses[extensions_descriptor_url]
+                if isinstance(response, requests.exceptions.RequestException):
+                    raise response
                 extensions_descriptor = response.json()
 
             except ValueError:  # would be json.JSONDecodeError for Python 3.5+
@@ -259,6 +306,8 @@ class SchemaOCDS(SchemaJsonMixin):
     def record_pkg_schema_str(self):
         uri_scheme = urlparse(self.record_pkg_schema_url).scheme
         if uri_scheme == 'http' or uri_scheme == 'https':
+            if self.schema_cache_dir:
+                return disk_cached_get_text(self.record_pkg_schema_url, self.schema_cache_dir)
             if self.cache_schema:
                 response = cached_get_request(self.record_pkg_schema_url)
             else:
@@ -270,17 +319,19 @@ class SchemaOCDS(SchemaJsonMixin):
 
     @property
     def _record_pkg_schema_obj(self):
-        return json.loads(self.record_pkg_schema_str)
+        return json_loads(self.record_pkg_schema_str)
 
     def get_record_pkg_schema_obj(self, deref=False):
         if deref:
-            deref_package_schema = self.deref_schema(self.record_pkg_schema_str)
+            deref_package_schema = self.deref_schema(self.record_pkg_schema_str, cache=not self.extended)
             if self.extended:
                 deref_release_schema_obj = self.get_release_schema_obj(deref=True)
                 deref_package_schema['properties']['records']['items']['properties']['compiledRelease'] = deref_release_schema_obj
                 deref_package_schema['properties']['records']['items']['properties']['releases']['oneOf'][1] = deref_release_schema_obj
             return deref_package_schema
-        return deepcopy(self._record_pkg_schema_obj)
+        return self._record_pkg_schema_obj
 
     def get_record_pkg_schema_fields(self):
-        return set(schema_dict_fields_generator(self.get_record_pkg_schema_obj(deref=True)))
+        if self.extended:
+            return set(schema_dict_fields_generator(self.get_record_pkg_schema_obj(deref=True)))
+        return self.deref_schema_fields(self.record_pkg_schema_str)
@@ -1,11 +1,9 @@
-import json
-import os
 import sys
 
 from django.conf import settings
 from django.core.management.base import CommandError
 
-from cove.management.commands.base_command import CoveBaseCommand, SetEncoder
+from cove.management.commands.base_command import CoveBaseCommand
 from cove_ocds.lib.api import APIException, ocds_json_output
 
 
@@ -37,5 +35,4 @@ class Command(CoveBaseCommand):
             self.stdout.write(str(e))
             sys.exit(1)
 
-        with open(os.path.join(self.output_dir, "results.json"), 'w+') as result_file:
-            json.dump(result, result_file, indent=2, sort_keys=True, cls=SetEncoder)
+        self.write_json('results.json', result, sort_keys=True)
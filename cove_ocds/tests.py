@@ -4,9 +4,10 @@ import io
 import time
 import uuid
 from collections import OrderedDict
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 import pytest
+import requests
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import UploadedFile
@@ -16,9 +17,10 @@ from django.core.management.base import CommandError
 import cove.lib.common as cove_common
 from .lib.api import APIException, context_api_transform, ocds_json_output
 from .lib.ocds import get_releases_aggregates, get_bad_ocds_prefixes
-from .lib.schema import SchemaOCDS
+from .lib.schema import SchemaOCDS, merge_patch
 from cove.input.models import SuppliedData
 from cove.lib.converters import convert_json, convert_spreadsheet
+from cove.lib.tools import disk_cached_get_text
 
 
 OCDS_DEFAULT_SCHEMA_VERSION = settings.COVE_CONFIG['schema_version']
@@ -263,6 +265,35 @@ def test_get_schema_validation_errors():
         assert len(error_list) > 0
 
 
+def test_get_cached_schema_validator():
+    schema_obj = SchemaOCDS(select_version='1.0')
+    schema_name = schema_obj.release_pkg_schema_name
+    schema_validator = cove_common.get_cached_schema_validator(schema_obj, schema_name)
+    assert cove_common.get_cached_schema_validator(SchemaOCDS(select_version='1.0'), schema_name) is schema_validator
+    assert cove_common.get_cached_schema_validator(SchemaOCDS(select_version='1.1'), schema_name) is not schema_validator
+    assert cove_common.get_cached_schema_validator(schema_obj, schema_obj.record_pkg_schema_name) is not schema_validator
+
+    schema_obj.extended = True
+    schema_obj.extended_schema_file = os.path.join('cove_ocds', 'fixtures', 'release_schema_deprecated_fields.json')
+    assert cove_common.get_cached_schema_validator(schema_obj, schema_name) is not schema_validator
+
+
+@pytest.mark.parametrize('file_name', [
+    'tenders_releases_2_releases.json',
+    'tenders_releases_2_releases_invalid.json',
+])
+@pytest.mark.parametrize('select_version', ['1.0', '1.1'])
+def test_fast_validator_ocds(file_name, select_version):
+    schema_obj = SchemaOCDS(select_version=select_version)
+    schema_name = schema_obj.release_pkg_schema_name
+    schema_validator = cove_common.get_schema_validator(schema_obj, schema_name)
+    fast_validator = cove_common.FastValidator(schema_obj, schema_name, schema_validator)
+    with open(os.path.join('cove_ocds', 'fixtures', file_name)) as fp:
+        json_data = json.load(fp)
+    expected = [(e.message, list(e.path)) for e in schema_validator.iter_errors(json_data)]
+    assert [(e.message, list(e.path)) for e in fast_validator.iter_errors(json_data)] == expected
+
+
 def test_get_json_data_generic_paths():
     with open(os.path.join('cove_ocds', 'fixtures', 'tenders_releases_2_releases_with_deprecated_fields.json')) as fp:
         json_data_w_deprecations = json.load(fp)
@@ -653,6 +684,50 @@ def test_schema_ocds_extensions(release_data, extensions, invalid_extension, ext
         assert not release_schema_obj['definitions']['Award']['properties'].get('agreedMetrics')
 
 
+def test_merge_patch():
+    target = {'a': 'b', 'c': {'d': 'e', 'f': 'g'}, 'h': ['i']}
+    merge_patch(target, {'a': 'z', 'c': {'f': None, 'x': {'y': None}}, 'h': {'j': 'k'}})
+    assert target == {'a': 'z', 'c': {'d': 'e', 'x': {}}, 'h': {'j': 'k'}}
+
+
+def test_schema_ocds_disk_cache_error_not_kept(tmpdir):
+    disk_cached_get_text.cache_clear()
+    with patch('cove.lib.tools.requests.get') as mock_get:
+        mock_get.return_value = Mock(status_code=502, headers={}, text='<html>Bad Gateway</html>')
+        mock_get.return_value.raise_for_status.side_effect = requests.exceptions.HTTPError
+        schema = SchemaOCDS(select_version='1.1')
+        schema.schema_cache_dir = str(tmpdir)
+        with pytest.raises(requests.exceptions.HTTPError):
+            schema.record_pkg_schema_str
+
+        mock_get.return_value = Mock(status_code=200, headers={}, text='{"id": "record"}')
+        schema = SchemaOCDS(select_version='1.1')
+        schema.schema_cache_dir = str(tmpdir)
+        assert schema.record_pkg_schema_str == '{"id": "record"}'
+    disk_cached_get_text.cache_clear()
+
+
+def test_schema_ocds_deref_shared():
+    schema = SchemaOCDS(select_version='1.1')
+    deref_pkg_schema = schema.get_release_pkg_schema_obj(deref=True)
+    assert SchemaOCDS(select_version='1.1').get_release_pkg_schema_obj(deref=True) is deref_pkg_schema
+    assert schema.deref_schema(schema.release_pkg_schema_str, cache=False) is not deref_pkg_schema
+    schema_fields = schema.get_release_pkg_schema_fields()
+    assert '/releases/awards/id' in schema_fields
+    assert SchemaOCDS(select_version='1.1').get_release_pkg_schema_fields() is schema_fields
+
+    extended_schema = SchemaOCDS(release_data={'version': '1.1', 'extensions': [METRICS_EXT]})
+    extended_schema.get_release_schema_obj()
+    extended_record_schema = extended_schema.get_record_pkg_schema_obj(deref=True)
+    record_schema = SchemaOCDS(select_version='1.1').get_record_pkg_schema_obj(deref=True)
+    assert 'agreedMetrics' in extended_record_schema['properties']['records']['items']['properties']['compiledRelease'][
+        'properties']['awards']['items']['properties']
+    assert 'agreedMetrics' not in record_schema['properties']['records']['items']['properties']['compiledRelease'][
+        'properties']['awards']['items']['properties']
+    assert '/releases/awards/agreedMetrics' in extended_schema.get_release_pkg_schema_fields()
+    assert '/releases/awards/agreedMetrics' not in schema_fields
+
+
 @pytest.mark.django_db
 def test_schema_ocds_extended_release_schema_file():
     data = SuppliedData.objects.create()